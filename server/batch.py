@@ -0,0 +1,147 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, Iterator
+
+import numpy as np
+from catalogue import catalogue_version
+from matcher import match, preload, ImageSource, MATCHER_MODES
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif'}
+
+
+def _match_one(data: ImageSource, mode: str) -> tuple[str, list[list], float]:
+    started = time.perf_counter()
+    name, lines, _, _ = match(data, mode)
+    return name, lines, time.perf_counter() - started
+
+
+def _read_source(source: ImageSource) -> tuple[str, ImageSource, str]:
+    # Returns a display name, the payload shipped to a worker and its content hash.
+    if isinstance(source, np.ndarray):
+        return '<array>', source, hashlib.sha256(source.tobytes()).hexdigest()
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            data = f.read()
+        return source, data, hashlib.sha256(data).hexdigest()
+    data = bytes(source)
+    return '<bytes>', data, hashlib.sha256(data).hexdigest()
+
+
+def match_many(sources: Iterable[ImageSource], mode: str = 'brute', workers: int | None = None,
+               skip_hashes: set[str] | None = None) -> Iterator[dict]:
+    """Match many images across a process pool, yielding one record per image as it finishes.
+
+    Every worker loads the catalogue once. Images whose content hash is in
+    `skip_hashes` are not matched again; they are reported with 'skipped' set.
+    """
+    if mode not in MATCHER_MODES:
+        raise ValueError(f"Unknown matcher mode {mode!r}, expected one of {MATCHER_MODES}")
+    workers = workers or os.cpu_count() or 1
+    skip_hashes = set(skip_hashes or ())
+    version = catalogue_version()
+    max_in_flight = workers * 2
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=preload) as executor:
+        pending = {}
+        for source in sources:
+            try:
+                name, data, digest = _read_source(source)
+            except OSError as e:
+                yield {'source': str(source), 'error': str(e)}
+                continue
+            if digest in skip_hashes:
+                yield {'source': name, 'sha256': digest, 'skipped': True}
+                continue
+            skip_hashes.add(digest)
+            pending[executor.submit(_match_one, data, mode)] = (name, digest)
+
+            while len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _record(future, *pending.pop(future), mode, version)
+
+        for future in list(pending):
+            yield _record(future, *pending.pop(future), mode, version)
+
+
+def _record(future, name: str, digest: str, mode: str, version: str) -> dict:
+    record = {'source': name, 'sha256': digest, 'mode': mode, 'catalogue_version': version}
+    try:
+        matched_name, lines, elapsed = future.result()
+    except Exception as e:
+        record['error'] = str(e)
+        return record
+    record.update({'matched_name': matched_name, 'lines': lines, 'elapsed': round(elapsed, 4)})
+    return record
+
+
+def iter_image_paths(paths: Iterable[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for filename in sorted(files):
+                    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def processed_hashes(results_path: str, mode: str) -> set[str]:
+    # Hashes already matched successfully with the current catalogue and mode.
+    version = catalogue_version()
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('mode') == mode and record.get('catalogue_version') == version and 'error' not in record:
+                done.add(record['sha256'])
+    return done
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Match star images in bulk and stream results as JSON lines.")
+    parser.add_argument('paths', nargs='+', help="image files or directories to scan")
+    parser.add_argument('-o', '--output', help="append results to this file instead of stdout")
+    parser.add_argument('-m', '--mode', default='brute', choices=MATCHER_MODES)
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--resume', action='store_true', help="skip images already in --output")
+    args = parser.parse_args(argv)
+
+    if args.resume and not args.output:
+        parser.error("--resume needs --output")
+    skip = processed_hashes(args.output, args.mode) if args.resume else set()
+    out = open(args.output, 'a') if args.output else sys.stdout
+
+    processed = skipped = failed = 0
+    started = time.perf_counter()
+    try:
+        for record in match_many(iter_image_paths(args.paths), args.mode, args.workers, skip):
+            if record.get('skipped'):
+                skipped += 1
+                continue
+            processed += 1
+            failed += 'error' in record
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - started
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {processed} images ({skipped} skipped, {failed} failed) in {elapsed:.2f}s: "
+          f"{rate:.2f} images/sec", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
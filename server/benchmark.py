@@ -0,0 +1,173 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+from catalogue import BASE_DIR, catalogue_version
+from data.constellation import constellation_names
+from line_index import get_line_index
+from matcher import find_lines, find_stars, identify_stars, load_image, preload, MATCHER_MODES
+import synthetic
+
+EXAMPLES_GLOB = os.path.join(BASE_DIR, '..', 'examples', 'inputs', 'image*.png')
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    if not samples:
+        return {}
+    values = np.asarray(samples)
+    return {
+        'n': len(values),
+        'mean': round(float(values.mean()), 6),
+        'p50': round(float(np.percentile(values, 50)), 6),
+        'p90': round(float(np.percentile(values, 90)), 6),
+        'p99': round(float(np.percentile(values, 99)), 6),
+        'max': round(float(values.max()), 6),
+    }
+
+
+def match_stage(dots: list[tuple[float, float]], mode: str) -> dict[int, float]:
+    # The same brightest-first capping and widening match() does.
+    return identify_stars(dots, mode)[0]
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def run_pipeline(image: np.ndarray, modes: list[str], stages: dict[str, list[float]]) -> tuple[int, dict[str, str | None]]:
+    # Detects once, then matches the same stars with every mode.
+    (dots, _), elapsed = timed(find_stars, image)
+    stages.setdefault('find_stars', []).append(elapsed)
+    names = {}
+    for mode in modes:
+        matches, elapsed = timed(match_stage, dots, mode)
+        stages.setdefault(f'match_{mode}', []).append(elapsed)
+        (names[mode], _, _), elapsed = timed(find_lines, matches, get_line_index(), dots)
+        stages.setdefault(f'find_lines_{mode}', []).append(elapsed)
+    return len(dots), names
+
+
+def bench_examples(paths: list[str], modes: list[str], repeat: int) -> dict:
+    images = []
+    totals: dict[str, list[float]] = {}
+    for path in paths:
+        stages: dict[str, list[float]] = {'decode': []}
+        for _ in range(repeat):
+            image, elapsed = timed(load_image, path)
+            stages['decode'].append(elapsed)
+            stars, names = run_pipeline(image, modes, stages)
+        images.append({
+            'image': os.path.basename(path),
+            'stars': stars,
+            'matched_name': {mode: constellation_names.get(name, name) for mode, name in names.items()},
+            'stages': {stage: percentiles(samples) for stage, samples in stages.items()},
+        })
+        for stage, samples in stages.items():
+            totals.setdefault(stage, []).extend(samples)
+    return {'images': images, 'stages': {stage: percentiles(samples) for stage, samples in totals.items()}}
+
+
+def bench_synthetic(cons: list[str], modes: list[str], rng: np.random.Generator, per_constellation: int,
+                    field: dict) -> dict:
+    correct = {mode: 0 for mode in modes}
+    per_con = {}
+    stages: dict[str, list[float]] = {}
+    cases = 0
+    for con in cons:
+        per_con[con] = {mode: 0 for mode in modes}
+        for _ in range(per_constellation):
+            points, _ = synthetic.make_field(con, rng, **field)
+            image = synthetic.render_field(points, field['size'])
+            cases += 1
+            _, names = run_pipeline(image, modes, stages)
+            for mode, name in names.items():
+                if name == con:
+                    correct[mode] += 1
+                    per_con[con][mode] += 1
+    return {
+        'cases': cases,
+        'accuracy': {mode: round(hits / cases, 4) if cases else None for mode, hits in correct.items()},
+        'stages': {stage: percentiles(samples) for stage, samples in stages.items()},
+        'per_constellation': per_con,
+    }
+
+
+def bench_scaling(con: str, modes: list[str], rng: np.random.Generator, counts: list[int],
+                  max_brute_stars: int, size: int) -> list[dict]:
+    rows = []
+    for count in counts:
+        fakes = max(count - len(synthetic.reconstruct_constellation(con)), 0)
+        points, _ = synthetic.make_field(con, rng, size=size, fake_stars=fakes)
+        # make_field lists the real stars first; matchers that take stars in
+        # brightness order must not get them ahead of the fakes for free.
+        dots = [tuple(point) for point in rng.permutation(points)]
+        row = {'stars': len(points)}
+        for mode in modes:
+            if mode == 'brute' and len(points) > max_brute_stars:
+                row[mode] = None
+                continue
+            _, row[mode] = timed(match_stage, dots, mode)
+            row[mode] = round(row[mode], 6)
+        rows.append(row)
+    return rows
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Time each match stage and measure identification accuracy.")
+    parser.add_argument('--inputs', default=EXAMPLES_GLOB, help="glob of real images to time")
+    parser.add_argument('--modes', nargs='+', default=list(MATCHER_MODES), choices=MATCHER_MODES)
+    parser.add_argument('--repeat', type=int, default=5, help="timing repeats per real image")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--constellations', nargs='*', help="synthetic constellations (default: all drawable)")
+    parser.add_argument('--per-constellation', type=int, default=1, help="synthetic fields per constellation")
+    parser.add_argument('--size', type=int, default=1000, help="synthetic image side in pixels")
+    parser.add_argument('--rotation', type=float, default=180.0, help="max absolute rotation in degrees")
+    parser.add_argument('--scale', type=float, nargs=2, default=(0.5, 0.8), help="constellation extent range, fraction of size")
+    parser.add_argument('--noise', type=float, default=0.0, help="positional noise sigma in pixels")
+    parser.add_argument('--fake-stars', type=int, default=0, help="random stars injected per synthetic field")
+    parser.add_argument('--scaling', default='10,20,40,80,160', help="star counts for the scaling sweep ('' to skip)")
+    parser.add_argument('--scaling-constellation', default='Ori')
+    parser.add_argument('--max-brute-stars', type=int, default=120)
+    parser.add_argument('-o', '--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    preload()
+    rng = np.random.default_rng(args.seed)
+    field = {'size': args.size, 'rotation': args.rotation, 'scale': tuple(args.scale),
+             'noise': args.noise, 'fake_stars': args.fake_stars}
+    cons = args.constellations or synthetic.drawable_constellations()
+    counts = [int(count) for count in args.scaling.split(',') if count]
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'catalogue_version': catalogue_version(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'config': {**vars(args), 'constellations': cons},
+        'examples': bench_examples(sorted(glob.glob(args.inputs)), args.modes, args.repeat),
+        'synthetic': bench_synthetic(cons, args.modes, rng, args.per_constellation, field),
+        'scaling': bench_scaling(args.scaling_constellation, args.modes, rng, counts, args.max_brute_stars, args.size),
+    }
+    report['elapsed'] = round(time.perf_counter() - started, 3)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    accuracy = ', '.join(f"{mode} {value:.1%}" for mode, value in report['synthetic']['accuracy'].items() if value is not None)
+    print(f"{report['synthetic']['cases']} synthetic fields ({accuracy}) in {report['elapsed']:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
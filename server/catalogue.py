@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from sklearn.neighbors import KDTree
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRIANGLES_PATH = os.path.join(BASE_DIR, 'data', 'triangles.csv')
+LINES_PATH = os.path.join(BASE_DIR, 'constellation_lines.py')
+CATALOGUE_DIR = os.path.join(BASE_DIR, 'data', 'catalogue')
+
+RECORDS_FILE = 'triangles.npy'
+CONSTELLATIONS_FILE = 'constellations.json'
+TREE_FILE = 'kdtree.pkl'
+
+RECORD_DTYPE = np.dtype([
+    ('angles', '<f4', (3,)),
+    ('hips', '<i4', (3,)),
+    ('con', 'u1'),
+])
+
+
+class Catalogue:
+    """Triangle catalogue backed by a memory-mapped record array.
+
+    Pages of the record file are shared between every process that maps it;
+    the KDTree is only unpickled (or built) the first time `tree` is used.
+    """
+
+    def __init__(self, records: np.ndarray, constellations: list[str], tree_path: str | None = None):
+        self.records = records
+        self.constellations = constellations
+        self.tree_path = tree_path
+        self._tree: KDTree | None = None
+        self._hips: np.ndarray | None = None
+        self._subtrees: dict[int, tuple[np.ndarray, cKDTree]] = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def angles(self) -> np.ndarray:
+        return self.records['angles']
+
+    @property
+    def hips(self) -> np.ndarray:
+        # Matches have always been reported as float HIP numbers.
+        if self._hips is None:
+            self._hips = self.records['hips'].astype(np.float64)
+        return self._hips
+
+    @property
+    def con_codes(self) -> np.ndarray:
+        return self.records['con']
+
+    @property
+    def cons(self) -> np.ndarray:
+        return np.asarray(self.constellations)[self.con_codes]
+
+    @property
+    def tree(self) -> KDTree:
+        if self._tree is None:
+            if self.tree_path and os.path.exists(self.tree_path):
+                with open(self.tree_path, 'rb') as f:
+                    self._tree = pickle.load(f)
+            else:
+                self._tree = build_tree(self.records)
+        return self._tree
+
+    def subtree(self, code: int) -> tuple[np.ndarray, cKDTree]:
+        # Rows of one constellation and a tree over just their angles; tree query
+        # indices are positions in the returned rows. scipy's tree, because its
+        # distance_upper_bound prunes the many image triangles far from this
+        # constellation several times faster than sklearn's KDTree.
+        if code not in self._subtrees:
+            rows = np.flatnonzero(self.con_codes == code)
+            self._subtrees[code] = rows, cKDTree(self.angles[rows].astype(np.float64))
+        return self._subtrees[code]
+
+
+def build_tree(records: np.ndarray) -> KDTree:
+    return KDTree(records['angles'].astype(np.float64))
+
+
+def _write_atomic(path: str, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def compile_catalogue(csv_path: str = TRIANGLES_PATH, output_dir: str = CATALOGUE_DIR) -> Catalogue:
+    metrics = pd.read_csv(csv_path)
+    constellations = sorted(metrics['con'].unique())
+
+    records = np.empty(len(metrics), dtype=RECORD_DTYPE)
+    records['angles'] = metrics[['angle1', 'angle2', 'angle3']].to_numpy(dtype=np.float32)
+    records['hips'] = metrics[['hip1', 'hip2', 'hip3']].to_numpy(dtype=np.int32)
+    records['con'] = pd.Categorical(metrics['con'], categories=constellations).codes
+
+    os.makedirs(output_dir, exist_ok=True)
+    tree_path = os.path.join(output_dir, TREE_FILE)
+    _write_atomic(os.path.join(output_dir, CONSTELLATIONS_FILE),
+                  lambda f: f.write(json.dumps(constellations).encode()))
+    _write_atomic(tree_path, lambda f: pickle.dump(build_tree(records), f, protocol=pickle.HIGHEST_PROTOCOL))
+    # Records go last: their mtime marks the whole directory as up to date.
+    _write_atomic(os.path.join(output_dir, RECORDS_FILE), lambda f: np.save(f, records))
+    return Catalogue(records, constellations, tree_path)
+
+
+def is_stale(csv_path: str = TRIANGLES_PATH, catalogue_dir: str = CATALOGUE_DIR) -> bool:
+    records_path = os.path.join(catalogue_dir, RECORDS_FILE)
+    return not os.path.exists(records_path) or os.path.getmtime(records_path) < os.path.getmtime(csv_path)
+
+
+def load_catalogue(catalogue_dir: str = CATALOGUE_DIR) -> Catalogue:
+    records = np.load(os.path.join(catalogue_dir, RECORDS_FILE), mmap_mode='r')
+    with open(os.path.join(catalogue_dir, CONSTELLATIONS_FILE)) as f:
+        constellations = json.load(f)
+    return Catalogue(records, constellations, os.path.join(catalogue_dir, TREE_FILE))
+
+
+def catalogue_version(paths: tuple[str, ...] = (TRIANGLES_PATH, LINES_PATH)) -> str:
+    # Changes whenever the triangles or the stick figures do, invalidating cached results.
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+_catalogue: Catalogue | None = None
+
+
+def get_catalogue() -> Catalogue:
+    global _catalogue
+    if _catalogue is None:
+        if is_stale():
+            compile_catalogue()
+        _catalogue = load_catalogue()
+    return _catalogue
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else CATALOGUE_DIR
+    compiled = compile_catalogue(output_dir=output)
+    print(f"Compiled {len(compiled)} triangles ({len(compiled.constellations)} constellations) to {output}")
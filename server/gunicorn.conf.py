@@ -0,0 +1,27 @@
+import gc
+import os
+
+# Production entry point: gunicorn -c gunicorn.conf.py server:app
+#
+# The app is imported once in the master, which then loads the catalogue,
+# KDTrees and indexes and runs a warm-up match before forking. Workers share
+# those pages copy-on-write instead of loading their own copies.
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+# server.py splits its match pool between the workers.
+os.environ['WEB_WORKERS'] = str(workers)
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+preload_app = True
+accesslog = '-'
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before the first fork.
+    from matcher import warm_up
+    warm_up()
+    # Keep the loaded objects out of the collector so it doesn't dirty their shared pages.
+    gc.freeze()
+    server.log.info("Catalogue loaded and warmed up")
@@ -0,0 +1,137 @@
+import os
+import sys
+import numpy as np
+from catalogue import BASE_DIR, Catalogue, catalogue_version, get_catalogue
+from constellation_lines import lines
+
+INDEX_PATH = os.path.join(BASE_DIR, 'data', 'invariant_index.npz')
+
+BUCKET_SIZE = 0.5  # degrees per quantized angle bucket
+
+
+class InvariantIndex:
+    """Catalogue triangles hashed by their two smallest angles.
+
+    The third angle is implied (they sum to 180), so a (q1, q2) bucket pair is a
+    similarity invariant of the triangle. Entries are kept sorted by bucket key,
+    which lets a batch of lookups run as a single `np.searchsorted`.
+    """
+
+    def __init__(self, keys: np.ndarray, rows: np.ndarray, angles: np.ndarray,
+                 hips: np.ndarray, cons: np.ndarray, weights: np.ndarray,
+                 bucket_size: float = BUCKET_SIZE):
+        self.keys = keys
+        self.rows = rows
+        self.angles = angles
+        self.hips = hips
+        self.cons = cons
+        self.weights = weights
+        self.bucket_size = bucket_size
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def query(self, angles: np.ndarray, tolerance: float,
+              k: int | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Returns (query id, catalogue row, angle distance) for every catalogue
+        # triangle within `tolerance` degrees of a query triangle, or only for
+        # the `k` nearest of them per query triangle.
+        q1, q2 = quantize(angles[:, 0], self.bucket_size), quantize(angles[:, 1], self.bucket_size)
+        reach = int(np.ceil(tolerance / self.bucket_size))
+        steps = np.arange(-reach, reach + 1)
+        d1, d2 = np.meshgrid(steps, steps, indexing='ij')
+        probe_keys = bucket_key(q1[:, None] + d1.ravel(), q2[:, None] + d2.ravel(), self.bucket_size)
+
+        lo = np.searchsorted(self.keys, probe_keys.ravel(), side='left')
+        hi = np.searchsorted(self.keys, probe_keys.ravel(), side='right')
+        counts = hi - lo
+        total = int(counts.sum())
+        if not total:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty, np.empty(0)
+
+        probe_query = np.repeat(np.arange(len(angles)), probe_keys.shape[1])
+        query_ids = np.repeat(probe_query, counts)
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        rows = self.rows[starts + np.arange(total)]
+
+        distances = np.linalg.norm(self.angles[rows] - angles[query_ids], axis=1)
+        keep = distances <= tolerance
+        query_ids, rows, distances = query_ids[keep], rows[keep], distances[keep]
+        if k is not None:
+            order = np.lexsort((distances, query_ids))
+            query_ids, rows, distances = query_ids[order], rows[order], distances[order]
+            rank = np.arange(len(query_ids)) - np.searchsorted(query_ids, query_ids)
+            nearest = rank < k
+            query_ids, rows, distances = query_ids[nearest], rows[nearest], distances[nearest]
+        return query_ids, rows, distances
+
+
+def quantize(angle: np.ndarray, bucket_size: float = BUCKET_SIZE) -> np.ndarray:
+    return np.floor(angle / bucket_size).astype(np.int64)
+
+
+def bucket_key(q1: np.ndarray, q2: np.ndarray, bucket_size: float = BUCKET_SIZE) -> np.ndarray:
+    # Shifted by one so the q - 1 neighbour of the first bucket stays non-negative.
+    buckets_per_axis = int(np.ceil(180 / bucket_size)) + 2
+    return (q1 + 1) * buckets_per_axis + (q2 + 1)
+
+
+def count_line_edges(hips: np.ndarray, cons: np.ndarray) -> np.ndarray:
+    edges = {(con, frozenset(pair)) for con, pairs in lines.items() for pair in pairs}
+    return np.array([
+        sum((con, frozenset(side)) in edges for side in ((a, b), (b, c), (a, c)))
+        for con, (a, b, c) in zip(cons, hips.tolist())
+    ], dtype=np.int8)
+
+
+def build_index(catalogue: Catalogue | None = None, bucket_size: float = BUCKET_SIZE) -> InvariantIndex:
+    catalogue = catalogue or get_catalogue()
+    angles = catalogue.angles.astype(np.float64)
+    hips = catalogue.hips
+    cons = catalogue.cons
+
+    # Triangles whose sides are drawn constellation lines are the shapes people
+    # actually photograph, so they vote once more per line edge they contain.
+    weights = 1 + count_line_edges(hips, cons)
+
+    keys = bucket_key(quantize(angles[:, 0], bucket_size), quantize(angles[:, 1], bucket_size), bucket_size)
+    order = np.argsort(keys, kind='stable')
+    return InvariantIndex(keys[order], order.astype(np.int32), angles, hips, cons, weights, bucket_size)
+
+
+def save_index(index: InvariantIndex, path: str = INDEX_PATH):
+    # Weights come from the stick figures, so the version covers both source files.
+    np.savez(path, keys=index.keys, rows=index.rows, angles=index.angles, hips=index.hips,
+             cons=index.cons, weights=index.weights, bucket_size=index.bucket_size,
+             version=catalogue_version())
+
+
+def load_index(path: str = INDEX_PATH) -> InvariantIndex:
+    with np.load(path) as data:
+        return InvariantIndex(data['keys'], data['rows'], data['angles'], data['hips'],
+                              data['cons'], data['weights'], float(data['bucket_size']))
+
+
+def is_stale(path: str = INDEX_PATH) -> bool:
+    if not os.path.exists(path):
+        return True
+    with np.load(path) as data:
+        return 'version' not in data.files or str(data['version']) != catalogue_version()
+
+
+_index: InvariantIndex | None = None
+
+
+def get_index() -> InvariantIndex:
+    global _index
+    if _index is None:
+        _index = build_index() if is_stale() else load_index()
+    return _index
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else INDEX_PATH
+    built = build_index()
+    save_index(built, output)
+    print(f"Wrote {len(built)} triangles to {output}")
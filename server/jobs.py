@@ -0,0 +1,146 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlite_store import execute
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Bounded process pool for match jobs.
+
+    At most `workers` jobs run at once and `queue_depth` more may wait; past
+    that `submit` raises QueueFull. Finished jobs are kept for `ttl` seconds so
+    clients can poll their result. The pool is started lazily through a fork
+    server, so it is safe to create the queue in a process that will fork. A
+    pool broken by a dead worker is replaced on the next submit; if the new one
+    breaks at once too, `submit` raises BrokenProcessPool.
+
+    With `store_path`, job states and JSON-serializable results are also kept
+    in SQLite, so any process using the same file (e.g. every web worker) can
+    answer `status` for a job another one accepted.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, ttl: float = 600.0, initializer=None,
+                 store_path: str | None = None):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.ttl = ttl
+        self.initializer = initializer
+        self.store_path = store_path
+        self._executor: ProcessPoolExecutor | None = None
+        self._executor_pid: int | None = None
+        self._jobs: dict[str, tuple[Future, float]] = {}
+        self._finished_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+        if store_path:
+            execute(self.store_path, "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                    "submitted_at REAL NOT NULL, finished_at REAL, value TEXT)")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=self.initializer,
+            )
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _evict_expired(self, now: float):
+        expired = [job_id for job_id, finished in self._finished_at.items() if now - finished > self.ttl]
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+            self._finished_at.pop(job_id, None)
+
+    def in_flight(self) -> int:
+        return sum(not future.done() for future, _ in self._jobs.values())
+
+    def submit(self, fn, *args, on_result=None) -> str:
+        # `on_result` runs in this process with fn's return value once it succeeds.
+        with self._lock:
+            now = time.time()
+            self._evict_expired(now)
+            if self.in_flight() >= self.workers + self.queue_depth:
+                raise QueueFull(f"{self.workers + self.queue_depth} jobs already queued or running")
+
+            job_id = uuid.uuid4().hex
+            try:
+                future = self._get_executor().submit(fn, *args)
+            except BrokenProcessPool:
+                self.shutdown()
+                future = self._get_executor().submit(fn, *args)
+            self._jobs[job_id] = (future, now)
+        if self.store_path:
+            execute(self.store_path, "DELETE FROM jobs WHERE finished_at < ?", (now - self.ttl,))
+            execute(self.store_path, "INSERT INTO jobs (job_id, status, submitted_at) VALUES (?, 'queued', ?)", (job_id, now))
+        # Added outside the lock: it runs right away if the job has already finished.
+        future.add_done_callback(lambda done: self._mark_finished(job_id, done, on_result))
+        return job_id
+
+    def completed(self, result) -> str:
+        # Registers a job that is already done (e.g. served from a cache), so
+        # clients polling by job id see it like any other.
+        now = time.time()
+        future = Future()
+        future.set_result(result)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._evict_expired(now)
+            self._jobs[job_id] = (future, now)
+            self._finished_at[job_id] = now
+        if self.store_path:
+            execute(self.store_path, "INSERT INTO jobs (job_id, status, submitted_at, finished_at, value) "
+                    "VALUES (?, 'done', ?, ?, ?)", (job_id, now, now, json.dumps({'result': result})))
+        return job_id
+
+    def _mark_finished(self, job_id: str, future: Future, on_result):
+        with self._lock:
+            if job_id in self._jobs:
+                self._finished_at[job_id] = time.time()
+        if self.store_path and not future.cancelled():
+            info = self._describe(future)
+            value = {key: info[key] for key in ('result', 'error') if key in info}
+            execute(self.store_path, "UPDATE jobs SET status = ?, finished_at = ?, value = ? WHERE job_id = ?",
+                    (info['status'], time.time(), json.dumps(value), job_id))
+        if on_result is not None and not future.cancelled() and future.exception() is None:
+            on_result(future.result())
+
+    def status(self, job_id: str) -> dict | None:
+        with self._lock:
+            entry = self._jobs.get(job_id)
+        if entry is None:
+            return self._stored_status(job_id)
+
+        future, submitted = entry
+        return {'job_id': job_id, 'submitted_at': submitted, **self._describe(future)}
+
+    @staticmethod
+    def _describe(future: Future) -> dict:
+        if not future.done():
+            return {'status': 'running' if future.running() else 'queued'}
+        if future.exception() is not None:
+            return {'status': 'failed', 'error': str(future.exception())}
+        return {'status': 'done', 'result': future.result()}
+
+    def _stored_status(self, job_id: str) -> dict | None:
+        # Jobs accepted by another process; a job still waiting there shows as queued.
+        if not self.store_path:
+            return None
+        row = execute(self.store_path, "SELECT status, submitted_at, value FROM jobs WHERE job_id = ?", (job_id,))
+        if row is None:
+            return None
+        status, submitted, value = row
+        return {'job_id': job_id, 'submitted_at': submitted, 'status': status, **json.loads(value or '{}')}
+
+    def shutdown(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
@@ -0,0 +1,44 @@
+from constellation_lines import lines as constellation_lines
+
+
+class LineIndex:
+    """Inverted index over constellation stick figures.
+
+    `pair_constellations` maps an unordered HIP pair to every constellation that
+    draws that edge, repeated as often as the edge is listed and in `lines`
+    order. `neighbours` and `hip_constellations` let callers only look at edges
+    touching the HIPs they actually matched.
+    """
+
+    def __init__(self, lines: dict[str, list[tuple[int, int]]]):
+        pair_constellations: dict[frozenset, list[str]] = {}
+        neighbours: dict[int, set[int]] = {}
+        hip_constellations: dict[int, set[str]] = {}
+
+        for constellation, pairs in lines.items():
+            for hip_1, hip_2 in pairs:
+                pair_constellations.setdefault(frozenset((hip_1, hip_2)), []).append(constellation)
+                neighbours.setdefault(hip_1, set()).add(hip_2)
+                neighbours.setdefault(hip_2, set()).add(hip_1)
+                hip_constellations.setdefault(hip_1, set()).add(constellation)
+                hip_constellations.setdefault(hip_2, set()).add(constellation)
+
+        self.pair_constellations = {pair: tuple(names) for pair, names in pair_constellations.items()}
+        self.neighbours = {hip: frozenset(hips) for hip, hips in neighbours.items()}
+        self.hip_constellations = {hip: frozenset(names) for hip, names in hip_constellations.items()}
+
+    def constellations_for(self, hip_1: float, hip_2: float) -> tuple[str, ...]:
+        return self.pair_constellations.get(frozenset((hip_1, hip_2)), ())
+
+    def contains(self, constellation: str, hip: float) -> bool:
+        return constellation in self.hip_constellations.get(hip, ())
+
+
+_line_index: LineIndex | None = None
+
+
+def get_line_index() -> LineIndex:
+    global _line_index
+    if _line_index is None:
+        _line_index = LineIndex(constellation_lines)
+    return _line_index
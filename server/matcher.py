@@ -1,187 +1,708 @@
-from sklearn.neighbors import KDTree 
-from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, combinations
+from math import comb
 from collections import Counter
 from data.constellation import constellation_names
-from constellation_lines import lines
+from catalogue import Catalogue, get_catalogue
+from invariant_index import InvariantIndex, get_index as get_invariant_index
+from line_index import LineIndex, get_line_index
 from datetime import datetime
+import os
+import time
+import telemetry
 import pandas as pd
 import numpy as np
 import cv2
-from data.constellation import constellation_names
-from constellation_lines import lines
 
-metrics = pd.read_csv('data/triangles.csv')
-tree = KDTree(metrics[['angle1', 'angle2', 'angle3']])
 
+_log_timestamp: tuple[int, str] = (-1, "")
 
 def format_log_message(message: str) -> str:
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    return f"[{timestamp}] {message}\n"
-
-def distance(a: pd.DataFrame, b: pd.DataFrame) -> float:
-    return np.sqrt(
-        (a['x'].values[0] - b['x'].values[0]) ** 2
-         + (a['y'].values[0] - b['y'].values[0]) ** 2
-    )
-
-def calculate_2d_triangle_angles(side_ab: float, side_bc: float, side_ac: float) -> np.ndarray:
+    # Logs are written many times a second; format the timestamp once per second.
+    global _log_timestamp
+    second = int(time.time())
+    if _log_timestamp[0] != second:
+        _log_timestamp = (second, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second)))
+    return f"[{_log_timestamp[1]}] {message}\n"
+
+def pairwise_distances(coords: np.ndarray) -> np.ndarray:
+    diff = coords[:, None, :] - coords[None, :, :]
+    return np.sqrt((diff ** 2).sum(axis=-1))
+
+def calculate_2d_triangle_angles(side_ab, side_bc, side_ac) -> np.ndarray:
     cos_A = (side_bc**2 + side_ac**2 - side_ab**2) / (2 * side_bc * side_ac)
     cos_B = (side_ab**2 + side_ac**2 - side_bc**2) / (2 * side_ab * side_ac)
     cos_C = (side_ab**2 + side_bc**2 - side_ac**2) / (2 * side_ab * side_bc)
-    
-    angles = np.degrees([
+
+    angles = np.degrees(np.stack([
         np.arccos(np.clip(cos_A, -1.0, 1.0)),
         np.arccos(np.clip(cos_B, -1.0, 1.0)),
         np.arccos(np.clip(cos_C, -1.0, 1.0))
-    ])
-    return np.sort(angles)
-
-def find_stars(path: str) -> tuple[list[tuple[float, float]], str]:
-    img = cv2.imread(path)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.medianBlur(gray, ksize=3)
-    _, thresh = cv2.threshold(blurred, 10, 255, cv2.THRESH_BINARY)
+    ], axis=-1))
+    return np.sort(angles, axis=-1)
+
+def enumerate_triangles(n: int) -> np.ndarray:
+    count = comb(n, 3)
+    flat = np.fromiter(chain.from_iterable(combinations(range(n), 3)), dtype=np.intp, count=3 * count)
+    return flat.reshape(count, 3)
+
+def triangles_per_star(triangles: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    # Groups triangle ids by star, each group sorted by the other two vertices, which is
+    # the order a per-star `combinations` loop visits them in (keeps tie-breaking stable).
+    # Returns the ordered ids and per-star offsets into them.
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    star = np.concatenate([a, b, c])
+    other_1 = np.concatenate([b, a, a])
+    other_2 = np.concatenate([c, c, b])
+    tri_ids = np.tile(np.arange(len(triangles)), 3)
+    order = np.lexsort((other_2, other_1, star))
+    offsets = np.searchsorted(star[order], np.arange(n + 1))
+    return tri_ids[order], offsets
+
+ImageSource = str | bytes | bytearray | memoryview | np.ndarray
+
+def load_image(source: ImageSource) -> np.ndarray:
+    # Paths are read from disk, raw bytes are decoded in memory, arrays pass through.
+    if isinstance(source, np.ndarray):
+        return source
+    with telemetry.stage('decode'):
+        if isinstance(source, str):
+            img = cv2.imread(source)
+        else:
+            img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img
+
+def encode_image(img: np.ndarray, ext: str = '.jpg') -> bytes:
+    ok, buffer = cv2.imencode(ext, img)
+    if not ok:
+        raise ValueError(f"Could not encode image as {ext}")
+    return buffer.tobytes()
+
+STAR_COLUMNS = ["x", "y", "area", "flux"]
+DEFAULT_THRESHOLD = 10
+ADAPTIVE_SIGMA = 5.0
+
+# Frames larger than TILE_SIZE are detected tile by tile on a thread pool (OpenCV
+# releases the GIL). Tiles overlap by TILE_OVERLAP pixels and each keeps only the
+# stars centred inside it, so a star on a seam is found once as long as it is
+# smaller than the overlap.
+TILE_SIZE = 2048
+TILE_OVERLAP = 32
+DETECTION_WORKERS = min(8, os.cpu_count() or 1)
+THRESHOLD_SAMPLE_PIXELS = 1_000_000
+
+def star_threshold(gray: np.ndarray, threshold: int | str = DEFAULT_THRESHOLD) -> int:
+    # 'adaptive' puts the cut ADAPTIVE_SIGMA robust deviations above the sky background,
+    # never below the fixed default, so hazy or light-polluted photos don't turn into one blob.
+    if threshold != 'adaptive':
+        return int(threshold)
+    step = max(1, int(np.sqrt(gray.size / THRESHOLD_SAMPLE_PIXELS)))
+    sample = cv2.medianBlur(np.ascontiguousarray(gray[::step, ::step]), ksize=3)
+    background = float(np.median(sample))
+    spread = 1.4826 * float(np.median(np.abs(sample - background)))
+    return int(min(max(background + ADAPTIVE_SIGMA * max(spread, 1.0), DEFAULT_THRESHOLD), 254))
+
+def _blobs(gray: np.ndarray, cut: int, blur: bool = True) -> list[tuple[float, float, float, float]]:
+    # (x, y, area, flux) of every blob above `cut`, with sub-pixel centroids.
+    blurred = cv2.medianBlur(gray, ksize=3) if blur else gray
+    _, thresh = cv2.threshold(blurred, cut, 255, cv2.THRESH_BINARY)
 
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    star_coords = []
-    img_with_stars = img.copy()
-    log_str = ""
-
-    for ind, contour in enumerate(contours):
+    rows = []
+    for contour in contours:
         area = cv2.contourArea(contour)
         if area > 0:
             moments = cv2.moments(contour)
             if moments['m00'] != 0:
-                x = int(moments['m10']/moments['m00'])
-                y = int(moments['m01']/moments['m00'])
-                star_coords.append((x, y))
-                cv2.rectangle(img_with_stars, (x-7, y-7), (x+7, y+7), (0, 0, 255), 1)
-                cv2.putText(img_with_stars, f"{ind}", (x + 10, y - 10), cv2.FONT_HERSHEY_SIMPLEX,0.5,(0, 0, 255), 2)
+                rows.append((moments['m10']/moments['m00'], moments['m01']/moments['m00'],
+                             area, _contour_flux(gray, thresh, contour)))
+    return rows
+
+def _contour_flux(gray: np.ndarray, thresh: np.ndarray, contour: np.ndarray) -> float:
+    # Sum of the thresholded pixels inside the contour, looked at only within its bounding box.
+    x, y, w, h = cv2.boundingRect(contour)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.drawContours(mask, [contour], -1, 1, thickness=cv2.FILLED, offset=(-x, -y))
+    mask &= thresh[y:y + h, x:x + w]
+    return float(gray[y:y + h, x:x + w][mask > 0].sum())
+
+def _detect_tiled(gray: np.ndarray, cut: int, tile_size: int, workers: int,
+                  blur: bool = True) -> list[tuple[float, float, float, float]]:
+    height, width = gray.shape
+    if height <= tile_size and width <= tile_size:
+        return _blobs(gray, cut, blur)
+
+    def detect_tile(origin: tuple[int, int]) -> list[tuple[float, float, float, float]]:
+        y0, x0 = origin
+        top, left = max(y0 - TILE_OVERLAP, 0), max(x0 - TILE_OVERLAP, 0)
+        crop = gray[top:y0 + tile_size + TILE_OVERLAP, left:x0 + tile_size + TILE_OVERLAP]
+        return [(x + left, y + top, area, flux) for x, y, area, flux in _blobs(crop, cut, blur)
+                if x0 <= x + left < x0 + tile_size and y0 <= y + top < y0 + tile_size]
+
+    origins = [(y0, x0) for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(chain.from_iterable(pool.map(detect_tile, origins)))
+
+def _detect_downscaled(gray: np.ndarray, cut: int, factor: int, tile_size: int,
+                       workers: int) -> list[tuple[float, float, float, float]]:
+    # Finds stars on a max-pooled copy of the denoised frame (pooling keeps faint
+    # peaks that averaging would wash out, and blurring after it would erase stars
+    # of a pixel or two), then measures each one at full resolution around it.
+    pooled = cv2.dilate(cv2.medianBlur(gray, ksize=3), np.ones((factor, factor), dtype=np.uint8), anchor=(0, 0))
+    small = np.ascontiguousarray(pooled[::factor, ::factor])
+
+    refined = {}
+    for x, y, area, _ in _detect_tiled(small, cut, tile_size, workers, blur=False):
+        cx, cy = (x + 0.5) * factor - 0.5, (y + 0.5) * factor - 0.5
+        radius = int(np.ceil((np.sqrt(area) + 2) * factor))
+        left, top = max(int(cx) - radius, 0), max(int(cy) - radius, 0)
+        window = gray[top:int(cy) + radius + 1, left:int(cx) + radius + 1]
+        blobs = _blobs(window, cut)
+        if blobs:
+            bx, by, b_area, b_flux = min(blobs, key=lambda b: (b[0] + left - cx) ** 2 + (b[1] + top - cy) ** 2)
+            refined[(round(bx + left, 2), round(by + top, 2))] = (bx + left, by + top, b_area, b_flux)
+    return list(refined.values())
+
+def detect_stars(img: np.ndarray, threshold: int | str = DEFAULT_THRESHOLD, downscale: int = 1,
+                 tile_size: int = TILE_SIZE, workers: int = DETECTION_WORKERS) -> pd.DataFrame:
+    """Centroid, contour area and integrated intensity of every star, brightest first.
+
+    `downscale` > 1 detects on a frame that many times smaller and refines each
+    star at full resolution, which is much faster on large photos but can miss
+    stars closer together than the factor.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    cut = star_threshold(gray, threshold)
+    if downscale > 1:
+        rows = _detect_downscaled(gray, cut, downscale, tile_size, workers)
+    else:
+        rows = _detect_tiled(gray, cut, tile_size, workers)
+
+    stars = pd.DataFrame(rows, columns=STAR_COLUMNS)
+    stars[["x", "y"]] = stars[["x", "y"]].round(2)
+    return stars.sort_values("flux", ascending=False, kind="stable").reset_index(drop=True)
+
+def find_stars(source: ImageSource, debug_dir: str | None = None, threshold: int | str = DEFAULT_THRESHOLD,
+               downscale: int = 1) -> tuple[list[tuple[float, float]], str]:
+    img = load_image(source)
+    with telemetry.stage('star_detection'):
+        stars = detect_stars(img, threshold, downscale)
+        star_coords = list(zip(stars["x"].tolist(), stars["y"].tolist()))
+    telemetry.count('stars_detected', len(star_coords))
+    log_str = ""
 
-    star_image_path = f'examples/logs/detected_{path.split("/")[-1]}'
-    cv2.imwrite(star_image_path, img_with_stars)
-    log_str += format_log_message(f"Detected {len(star_coords)} stars in {path}. Saved marked stars image to {star_image_path}")
+    source_name = os.path.basename(source) if isinstance(source, str) else "image"
+    log_str += format_log_message(f"Detected {len(star_coords)} stars in {source_name}.")
+    if debug_dir:
+        # Labels are brightness ranks, i.e. the star indices used in the matching log.
+        img_with_stars = img.copy()
+        for ind, (x, y) in enumerate(star_coords):
+            x, y = round(x), round(y)
+            cv2.rectangle(img_with_stars, (x-7, y-7), (x+7, y+7), (0, 0, 255), 1)
+            cv2.putText(img_with_stars, f"{ind}", (x + 10, y - 10), cv2.FONT_HERSHEY_SIMPLEX,0.5,(0, 0, 255), 2)
+        if not isinstance(source, str):
+            source_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.png"
+        star_image_path = os.path.join(debug_dir, f'detected_{source_name}')
+        cv2.imwrite(star_image_path, img_with_stars)
+        log_str += format_log_message(f"Saved marked stars image to {star_image_path}")
 
     return star_coords, log_str
 
+def line_votes(matches: dict[int, float], lines: LineIndex) -> list[tuple[str, int, int]]:
+    # One (constellation, star, star) vote per catalogued line joining two matched stars.
+    stars_by_hip: dict[float, list[int]] = {}
+    for i, hip in matches.items():
+        stars_by_hip.setdefault(hip, []).append(i)
+
+    # Only edges touching a matched HIP can vote; sorting the star pairs keeps
+    # the vote and drawing order of a full combinations() walk.
+    linked_stars = sorted(
+        (i, j)
+        for i, hip in matches.items()
+        for neighbour in lines.neighbours.get(hip, ())
+        if neighbour != hip
+        for j in stars_by_hip.get(neighbour, ())
+        if j > i
+    )
+    return [(constellation, i, j)
+            for i, j in linked_stars
+            for constellation in lines.constellations_for(matches[i], matches[j])]
+
+def vote_margin(tally) -> float:
+    # Lead of the top constellation over the runner-up, as a share of its votes;
+    # `tally` holds one vote count per constellation.
+    tally = np.asarray(tally, dtype=float)
+    if not tally.size or tally.max() <= 0:
+        return 0.0
+    runner_up = np.partition(tally, -2)[-2] if tally.size > 1 else 0.0
+    return float((tally.max() - runner_up) / tally.max())
+
 def find_lines(matches, lines, dots):
+    if not isinstance(lines, LineIndex):
+        lines = LineIndex(lines)
     pairs_to_draw = []
     name_votes = []
-    used_hips = set(matches.values())
     log_str = ""
 
-    for i, j in combinations(range(len(matches)), 2):
-        dot_1 = matches[i]
-        dot_2 = matches[j]
-        if dot_1 == dot_2:
-            continue
-        for constellation, pairs in lines.items():
-            for pair in pairs:
-                if dot_1 in pair and dot_2 in pair:
-                    name_votes.append(constellation)
-                    pairs_to_draw.append([dots[i], dots[j]])
+    for constellation, i, j in line_votes(matches, lines):
+        name_votes.append(constellation)
+        pairs_to_draw.append([dots[i], dots[j]])
 
     if not name_votes:
         log_str += format_log_message("No constellation identified.")
         return None, [], log_str
     
     name = Counter(name_votes).most_common(1)[0][0]
-    constellation_hips = set()
-    for pair in lines.get(name, []):
-        constellation_hips.update(pair)
 
-    fake_stars = [(i, hip) for i, hip in matches.items() if hip not in constellation_hips]
+    fake_stars = [(i, hip) for i, hip in matches.items() if not lines.contains(name, hip)]
     if fake_stars:
         log_str += format_log_message(f"Suspected fake stars (index, HIP): {fake_stars}")
 
     log_str += format_log_message(f"Identified constellation: {name} with {len(pairs_to_draw)} line pairs.")
     return name, pairs_to_draw, log_str
 
-def draw_lines(lines_to_draw, name: str, path: str):
-    img = cv2.imread(path)
-    for pair in lines_to_draw:
-        dot_1, dot_2 = pair[0], pair[1]
-        cv2.line(img, dot_1, dot_2, (255, 255, 0), 1)
-    output_path = f'examples/results/{name.lower()}.jpg'
-    cv2.imwrite(output_path, img)
-
-
-def choose_best_hip(idx: int, candidates: list[float],
-                    distances: dict[float, list[float]],
-                    used_hips: set[float]) -> tuple[float | None, str]: # updated
+def draw_lines(lines_to_draw, source: ImageSource, output_path: str | None = None, ext: str = '.jpg') -> bytes:
+    img = load_image(source).copy()
+    with telemetry.stage('line_drawing'):
+        for pair in lines_to_draw:
+            dot_1, dot_2 = pair[0], pair[1]
+            cv2.line(img, (round(dot_1[0]), round(dot_1[1])), (round(dot_2[0]), round(dot_2[1])), (255, 255, 0), 1)
+        if output_path:
+            cv2.imwrite(output_path, img)
+        return encode_image(img, ext)
+
+
+def vote_best_hip(idx: int, hips: np.ndarray, distances: np.ndarray,
+                  used_hips: set[float]) -> tuple[float | None, str]:
+    # Most votes wins, ties go to the smallest mean distance, and equal
+    # candidates keep first-seen order like Counter does.
     log_str = ""
-    if not candidates:
+    if used_hips and hips.size:
+        keep = ~np.isin(hips, list(used_hips))
+        hips, distances = hips[keep], distances[keep]
+    if not hips.size:
         return None, log_str
 
-    counter = Counter(candidates)
-    most_common = counter.most_common()
-    top_votes = most_common[0][1]
-    top_candidates = [hip for hip, votes in most_common if votes == top_votes and hip not in used_hips]
+    unique, first_seen, inverse, counts = np.unique(
+        hips, return_index=True, return_inverse=True, return_counts=True)
+    tied = np.flatnonzero(counts == counts.max())
+    tied = tied[np.argsort(first_seen[tied], kind='stable')]
 
-    if not top_candidates:
-        return None, log_str
+    if len(tied) == 1:
+        return float(unique[tied[0]]), log_str
 
-    if len(top_candidates) == 1:
-        chosen = top_candidates[0]
-    else:
-        chosen = min(top_candidates, key=lambda hip: np.mean(distances[hip]))
-        log_str += format_log_message(f"Resolved tie for star {idx} among HIPs {top_candidates} by choosing {chosen} with min mean distance {np.mean(distances[chosen]):.4f}")
+    mean_distances = [np.mean(distances[inverse == t]) for t in tied]
+    best = int(np.argmin(mean_distances))
+    chosen = float(unique[tied[best]])
+    top_candidates = unique[tied].tolist()
+    log_str += format_log_message(f"Resolved tie for star {idx} among HIPs {top_candidates} by choosing {chosen} with min mean distance {mean_distances[best]:.4f}")
     return chosen, log_str
 
-def match_stars_to_catalogue(df: pd.DataFrame, metrics: pd.DataFrame, tree: KDTree) -> tuple[dict[int, float], str]: # updated
-    used_hips: set[float] = set()
+def match_stars_to_catalogue(df: pd.DataFrame, catalogue: Catalogue) -> tuple[dict[int, float], str]: # updated
     matches: dict[int, float] = {}
     log_str = ""
 
-    for i in range(len(df)):
-        dot_1 = df.iloc[[i]]
-        hip_distances: dict[float, list[float]] = {}
-        hip_candidates: list[float] = []
+    coords = df[['x', 'y']].to_numpy()
+    n = len(coords)
+    if n >= 3:
+        # Every triangle is shared by its three stars, so the angles and the KDTree
+        # lookup are computed once per triangle instead of once per (star, triangle).
+        with telemetry.stage('triangle_generation'):
+            triangles = enumerate_triangles(n)
+            sides = pairwise_distances(coords)
+            a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+            angles = calculate_2d_triangle_angles(sides[a, b], sides[b, c], sides[a, c])
+        telemetry.count('triangles_evaluated', len(triangles))
+        tree = catalogue.tree
+        with telemetry.stage('kdtree_query'):
+            dist, ind = tree.query(angles, k=2)
+
+        matches, log_str = vote_triangle_hits(triangles, dist, ind, n, catalogue)
 
-        for j, k in combinations(range(len(df)), 2):
-            if i in [j, k]:
-                continue
-
-            dot_2 = df.iloc[[j]]
-            dot_3 = df.iloc[[k]]
-
-            AB = distance(dot_1, dot_2)
-            BC = distance(dot_2, dot_3)
-            AC = distance(dot_1, dot_3)
+    log_str += format_log_message(f"Matched {len(matches)} stars to catalog HIP numbers.")
+    return matches, log_str
 
-            angles = calculate_2d_triangle_angles(AB, BC, AC)
-            dist, ind = tree.query([angles], k=2)
+def vote_triangle_hits(triangles: np.ndarray, dist: np.ndarray, ind: np.ndarray, n: int,
+                       catalogue: Catalogue) -> tuple[dict[int, float], str]:
+    # Each star takes the HIP voted for most by the catalogue neighbours of its triangles.
+    used_hips: set[float] = set()
+    matches: dict[int, float] = {}
+    log_str = ""
+    with telemetry.stage('voting'):
+        catalogue_hips = catalogue.hips
+        tri_order, offsets = triangles_per_star(triangles, n)
+
+        for i in range(n):
+            rows = tri_order[offsets[i]:offsets[i + 1]]
+            hip_candidates = catalogue_hips[ind[rows]].reshape(-1)
+            hip_distances = np.repeat(dist[rows].reshape(-1), 3)
+
+            best_hip, hip_log = vote_best_hip(i, hip_candidates, hip_distances, used_hips)
+            log_str += hip_log
+            if best_hip is not None:
+                matches[i] = best_hip
+                used_hips.add(best_hip)
+    telemetry.count('candidates_voted', 3 * ind.shape[1] * len(tri_order))
+    return matches, log_str
 
-            for idx, d in zip(ind[0], dist[0]):
-                triangle = metrics.iloc[idx]
-                hips = [triangle['hip1'], triangle['hip2'], triangle['hip3']]
-                for hip in hips:
-                    if hip in used_hips:
-                        continue
-                    hip_candidates.append(hip)
-                    hip_distances.setdefault(hip, []).append(d)
+# Incremental matching adds stars brightest first. Each new star brings the
+# triangles it closes with the stars before it, and their close catalogue
+# neighbours vote for their constellation. Matching stops once the leading
+# constellation is far enough ahead or INCREMENTAL_SEARCH_SHARE of the time
+# budget is used: the final per-star vote over the same triangles takes about
+# as long again as finding them.
+INCREMENTAL_MIN_STARS = 6
+INCREMENTAL_MIN_CONFIDENCE = 0.7
+INCREMENTAL_TOLERANCE = 0.5  # degrees; farther neighbours don't vote for a constellation
+INCREMENTAL_SEARCH_SHARE = 0.4
+
+def triangles_closing_at(k: int) -> np.ndarray:
+    # Triangles of star k with every pair of stars 0..k-1, in enumerate_triangles order.
+    j, l = np.triu_indices(k, 1)
+    return np.stack([j, l, np.full_like(j, k)], axis=1)
+
+def match_stars_incrementally(df: pd.DataFrame, catalogue: Catalogue, time_budget: float | None = None,
+                              min_confidence: float = INCREMENTAL_MIN_CONFIDENCE,
+                              min_stars: int = INCREMENTAL_MIN_STARS) -> tuple[dict[int, float], float, str]:
+    """Match stars in row order until one constellation leads by `min_confidence`,
+    returning within about `time_budget` seconds. Returns the best-so-far matches
+    and the confidence."""
+    matches: dict[int, float] = {}
+    log_str = ""
+    started = time.perf_counter()
+
+    coords = df[['x', 'y']].to_numpy()
+    n = len(coords)
+    sides = pairwise_distances(coords)
+    tree = catalogue.tree
+    con_codes = catalogue.con_codes
+    tally = np.zeros(len(catalogue.constellations))
+    confidence = 0.0
+    processed = min(n, 2)
+    found_triangles, found_dist, found_ind = [], [], []
+
+    for k in range(2, n):
+        with telemetry.stage('triangle_generation'):
+            triangles = triangles_closing_at(k)
+            a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+            angles = calculate_2d_triangle_angles(sides[a, b], sides[b, c], sides[a, c])
+        with telemetry.stage('kdtree_query'):
+            dist, ind = tree.query(angles, k=2)
+        found_triangles.append(triangles)
+        found_dist.append(dist)
+        found_ind.append(ind)
+        np.add.at(tally, con_codes[ind[dist < INCREMENTAL_TOLERANCE]], 1)
+        processed = k + 1
+
+        confidence = vote_margin(tally)
+        if processed >= min_stars and confidence >= min_confidence:
+            break
+        if time_budget is not None and time.perf_counter() - started >= INCREMENTAL_SEARCH_SHARE * time_budget:
+            log_str += format_log_message(f"Time budget of {time_budget:.3f}s used up after {processed} of {n} stars.")
+            break
+    telemetry.count('triangles_evaluated', sum(len(t) for t in found_triangles))
+
+    if found_triangles:
+        matches, log_str_votes = vote_triangle_hits(
+            np.concatenate(found_triangles), np.concatenate(found_dist), np.concatenate(found_ind),
+            processed, catalogue)
+        log_str += log_str_votes
+        leader = catalogue.constellations[int(np.argmax(tally))]
+        log_str += format_log_message(f"Stopped after {processed} of {n} stars: {leader} leads with confidence {confidence:.2f}.")
 
-        best_hip, hip_log = choose_best_hip(i, hip_candidates, hip_distances, used_hips)
+    log_str += format_log_message(f"Matched {len(matches)} stars to catalog HIP numbers.")
+    return matches, confidence, log_str
+
+
+def local_triangles(coords: np.ndarray, neighbours: int) -> np.ndarray:
+    # Triangles formed by each star and pairs of its nearest image neighbours,
+    # deduplicated: O(n * neighbours^2) instead of every C(n, 3) triple.
+    n = len(coords)
+    neighbours = min(neighbours, n - 1)
+    if neighbours < 2:
+        return np.empty((0, 3), dtype=np.intp)
+    sides = pairwise_distances(coords)
+    np.fill_diagonal(sides, np.inf)
+    nearest = np.argpartition(sides, neighbours - 1, axis=1)[:, :neighbours]
+    pair_j, pair_k = np.triu_indices(neighbours, k=1)
+    triangles = np.stack([
+        np.repeat(np.arange(n), len(pair_j)),
+        nearest[:, pair_j].ravel(),
+        nearest[:, pair_k].ravel(),
+    ], axis=1)
+    return np.unique(np.sort(triangles, axis=1), axis=0)
+
+def vote_per_star(stars: np.ndarray, hips: np.ndarray, distances: np.ndarray, n: int) -> tuple[dict[int, float], str]:
+    # stars[v] received a vote for hips[v]; stars are assigned in index order.
+    used_hips: set[float] = set()
+    matches: dict[int, float] = {}
+    log_str = ""
+    order = np.argsort(stars, kind='stable')
+    offsets = np.searchsorted(stars[order], np.arange(n + 1))
+    for i in range(n):
+        votes = order[offsets[i]:offsets[i + 1]]
+        best_hip, hip_log = vote_best_hip(i, hips[votes], distances[votes], used_hips)
         log_str += hip_log
         if best_hip is not None:
-            matches[i] = float(best_hip)
+            matches[i] = best_hip
             used_hips.add(best_hip)
+    return matches, log_str
+
+def match_stars_by_invariants(df: pd.DataFrame, index: InvariantIndex, neighbours: int = 5,
+                              tolerance: float = 0.5, hits: int = 2) -> tuple[dict[int, float], str]:
+    matches: dict[int, float] = {}
+    log_str = ""
+
+    coords = df[['x', 'y']].to_numpy()
+    n = len(coords)
+    with telemetry.stage('triangle_generation'):
+        triangles = local_triangles(coords, neighbours)
+        if len(triangles):
+            sides = pairwise_distances(coords)
+            a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+            angles = calculate_2d_triangle_angles(sides[a, b], sides[b, c], sides[a, c])
+    telemetry.count('triangles_evaluated', len(triangles))
+    if len(triangles):
+        with telemetry.stage('index_query'):
+            # Each image triangle votes with its `hits` nearest catalogue triangles
+            # only, as in the brute-force matcher. Taking every one in range let a
+            # single shape repeated across a constellation (CrA is full of them)
+            # outvote the stars actually pictured.
+            query_ids, rows, dist = index.query(angles, tolerance, hits)
+        log_str += format_log_message(f"Hashed {len(triangles)} local triangles to {len(rows)} catalogue candidates.")
+
+        with telemetry.stage('voting'):
+            # Every hit votes for its three HIPs on each of the image triangle's three
+            # stars, once per unit of the catalogue triangle's weight.
+            weights = np.repeat(index.weights[rows], 9)
+            stars = np.repeat(np.repeat(triangles[query_ids], 3, axis=1).ravel(), weights)
+            hips = np.repeat(np.tile(index.hips[rows], (1, 3)).ravel(), weights)
+            distances = np.repeat(np.repeat(dist, 9), weights)
+            matches, log_votes = vote_per_star(stars, hips, distances, n)
+            log_str += log_votes
+        telemetry.count('candidates_voted', len(hips))
+
+    log_str += format_log_message(f"Matched {len(matches)} stars to catalog HIP numbers.")
+    return matches, log_str
+
+
+# The scoped matcher shortlists SCOPED_TOP_K constellations from a global query
+# of local triangles only (each star with pairs of its SCOPED_NEIGHBOURS nearest
+# stars), then matches every triangle against each one's own small tree with up
+# to SCOPED_NEIGHBOURS neighbours inside SCOPED_RADIUS degrees. The assignment
+# whose HIP triples reproduce the most image triangles wins; stars in none of
+# them are dropped.
+SCOPED_TOP_K = 3
+SCOPED_NEIGHBOURS = 8
+SCOPED_RADIUS = 0.75
+
+def triple_keys(hips: np.ndarray) -> np.ndarray:
+    # Order-independent int64 key of each row of three HIP numbers (all below 2**21).
+    ordered = np.sort(hips.astype(np.int64), axis=1)
+    return (ordered[:, 0] << 42) | (ordered[:, 1] << 21) | ordered[:, 2]
+
+def verify_assignment(matches: dict[int, float], triangles: np.ndarray, angles: np.ndarray,
+                      rows: np.ndarray, catalogue: Catalogue, radius: float) -> tuple[int, set[int]]:
+    # Image triangles of matched stars whose HIP triple is a catalogue triangle
+    # with the same angles; returns their number and the stars they cover.
+    if not matches:
+        return 0, set()
+    star_hips = np.full(triangles.max() + 1, -1.0)
+    star_hips[list(matches)] = list(matches.values())
+    complete = np.flatnonzero((star_hips[triangles] >= 0).all(axis=1))
+
+    known, first = np.unique(triple_keys(catalogue.hips[rows]), return_index=True)
+    keys = triple_keys(star_hips[triangles[complete]])
+    pos = np.minimum(np.searchsorted(known, keys), len(known) - 1)
+    found = known[pos] == keys
+    expected = catalogue.angles[rows[first[pos]]]
+    ok = found & (np.abs(angles[complete] - expected).max(axis=1) <= radius)
+    return int(ok.sum()), set(triangles[complete[ok]].ravel().tolist())
+
+def refine_in_constellation(triangles: np.ndarray, angles: np.ndarray, n: int, catalogue: Catalogue, code: int,
+                            neighbours: int, radius: float) -> tuple[dict[int, float], int, str]:
+    rows, tree = catalogue.subtree(code)
+    with telemetry.stage('kdtree_query'):
+        k = min(neighbours, len(rows))
+        dist, ind = tree.query(angles, k=k, distance_upper_bound=radius)
+        dist, ind = dist.reshape(-1, k), ind.reshape(-1, k)
+    tri_ids, nearest = np.nonzero(dist <= radius)
+    hit_rows = rows[ind[tri_ids, nearest]]
+
+    with telemetry.stage('voting'):
+        stars = np.repeat(triangles[tri_ids], 3, axis=1).ravel()
+        hips = np.tile(catalogue.hips[hit_rows], (1, 3)).ravel()
+        distances = np.repeat(dist[tri_ids, nearest], 9)
+        matches, log_str = vote_per_star(stars, hips, distances, n)
+    telemetry.count('candidates_voted', len(hips))
+
+    with telemetry.stage('verification'):
+        verified, verified_stars = verify_assignment(matches, triangles, angles, rows, catalogue, radius)
+    if verified:
+        matches = {i: hip for i, hip in matches.items() if i in verified_stars}
+    return matches, verified, log_str
+
+def match_stars_by_constellation(df: pd.DataFrame, catalogue: Catalogue, top_k: int = SCOPED_TOP_K,
+                                 neighbours: int = SCOPED_NEIGHBOURS,
+                                 radius: float = SCOPED_RADIUS) -> tuple[dict[int, float], str]:
+    matches: dict[int, float] = {}
+    log_str = ""
+
+    coords = df[['x', 'y']].to_numpy()
+    n = len(coords)
+    if n >= 3:
+        with telemetry.stage('triangle_generation'):
+            triangles = enumerate_triangles(n)
+            sides = pairwise_distances(coords)
+            a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+            angles = calculate_2d_triangle_angles(sides[a, b], sides[b, c], sides[a, c])
+            local = local_triangles(coords, neighbours)
+            a, b, c = local[:, 0], local[:, 1], local[:, 2]
+            local_angles = calculate_2d_triangle_angles(sides[a, b], sides[b, c], sides[a, c])
+        telemetry.count('triangles_evaluated', len(triangles))
+        with telemetry.stage('kdtree_query'):
+            dist, ind = catalogue.tree.query(local_angles, k=2)
+        # Large constellations collect stray hits just by size, so hits are scaled
+        # by the square root of each constellation's triangle count.
+        codes = len(catalogue.constellations)
+        tally = np.bincount(catalogue.con_codes[ind[dist <= radius]], minlength=codes)
+        score = tally / np.sqrt(np.maximum(np.bincount(catalogue.con_codes, minlength=codes), 1))
+        candidates = [int(code) for code in np.argsort(-score, kind='stable')[:top_k] if tally[code] > 0]
+        log_str += format_log_message(
+            f"{len(local)} local triangles shortlisted {[catalogue.constellations[code] for code in candidates]}.")
+
+        best_verified = 0
+        for code in candidates:
+            con_matches, verified, con_log = refine_in_constellation(
+                triangles, angles, n, catalogue, code, neighbours, radius)
+            log_str += format_log_message(
+                f"{catalogue.constellations[code]}: {verified} triangles verified for {len(con_matches)} stars.")
+            if verified > best_verified:
+                matches, best_verified = con_matches, verified
+                best_log = con_log
+        if best_verified:
+            log_str += best_log
 
     log_str += format_log_message(f"Matched {len(matches)} stars to catalog HIP numbers.")
     return matches, log_str
 
 
-def match(import_path: str) -> tuple[str, list[list], str]:
+MATCHER_MODES = ('brute', 'hash', 'incremental', 'scoped')
+
+# Matching starts with the brightest MAX_STARS stars and doubles the set until
+# the winning constellation has at least MIN_LINE_VOTES line votes and leads the
+# runner-up by at least MIN_VOTE_MARGIN of them, then doubles once more to pick
+# up stars of the figure just below the cut. If that doubling costs the winner
+# its lead, the extra stars were mostly faint noise and the narrower match is
+# kept. The set never grows past MAX_WIDENING * MAX_STARS stars.
+MAX_STARS = 10
+MIN_LINE_VOTES = 3
+MIN_VOTE_MARGIN = 0.5
+MAX_WIDENING = 4
+
+_preloaded = False
+
+def preload():
+    # Loads everything match() touches lazily, e.g. once per worker process.
+    global _preloaded
+    catalogue = get_catalogue()
+    catalogue.tree
+    for code in range(len(catalogue.constellations)):
+        catalogue.subtree(code)
+    get_line_index()
+    get_invariant_index()
+    _preloaded = True
+
+def is_preloaded() -> bool:
+    return _preloaded
+
+def warm_up():
+    # Preloads, then matches a small synthetic frame in every mode so the first
+    # real request doesn't pay for lazy imports and first-call allocations.
+    preload()
+    img = np.zeros((256, 256, 3), dtype=np.uint8)
+    for x, y in ((40, 50), (200, 60), (120, 200), (60, 150), (180, 180), (100, 90)):
+        cv2.circle(img, (x, y), 3, (255, 255, 255), -1)
+    for mode in MATCHER_MODES:
+        match(img, mode)
+    # They aren't traffic: keep them out of /metrics (and out of every forked worker's copy).
+    telemetry.reset()
+
+
+def identify_stars(dots: list[tuple[float, float]], mode: str = 'brute', max_stars: int | None = MAX_STARS,
+                   time_budget: float | None = None) -> tuple[dict[int, float], float | None, str]:
+    """HIP numbers of stars given brightest first, as find_stars returns them.
+
+    Also returns the 'incremental' mode's confidence, None in the other modes.
+    """
+    if mode not in MATCHER_MODES:
+        raise ValueError(f"Unknown matcher mode {mode!r}, expected one of {MATCHER_MODES}")
+    log_str = ""
+    lines = get_line_index()
+
+    if max_stars is None or mode == 'incremental':
+        n = limit = len(dots)
+    else:
+        limit = min(MAX_WIDENING * max_stars, len(dots))
+        n = min(max_stars, limit)
+    confident, confidence = None, None
+    while True:
+        if n < len(dots):
+            log_str += format_log_message(f"Matching the brightest {n} of {len(dots)} stars.")
+        df = pd.DataFrame(dots[:n], columns=["x", "y"])
+        if mode == 'hash':
+            matches, log_matching = match_stars_by_invariants(df, get_invariant_index())
+        elif mode == 'scoped':
+            matches, log_matching = match_stars_by_constellation(df, get_catalogue())
+        elif mode == 'incremental':
+            matches, confidence, log_matching = match_stars_incrementally(df, get_catalogue(), time_budget)
+        else:
+            matches, log_matching = match_stars_to_catalogue(df, get_catalogue())
+        log_str += log_matching
+        votes = line_votes(matches, lines)
+        tally = Counter(constellation for constellation, _, _ in votes)
+        margin = vote_margin(list(tally.values()))
+        leader = tally.most_common(1)[0][0] if tally else None
+        leads = len(votes) >= MIN_LINE_VOTES and margin >= MIN_VOTE_MARGIN
+        if confident is not None:
+            if not leads or leader != confident[0]:
+                log_str += format_log_message(
+                    f"Widening lost {confident[0]}'s lead, keeping the brightest {confident[1]} stars.")
+                matches = confident[2]
+            break
+        if leads:
+            confident = leader, n, matches
+        if n == limit:
+            break
+        log_str += format_log_message(f"{len(votes)} line votes with margin {margin:.2f}, widening the star set.")
+        n = min(2 * n, limit)
+    return matches, confidence, log_str
+
+
+def match(source: ImageSource, mode: str = 'brute', debug_dir: str | None = None,
+          max_stars: int | None = MAX_STARS, threshold: int | str = DEFAULT_THRESHOLD,
+          time_budget: float | None = None, downscale: int = 1) -> tuple[str, list[list], float | None, str]:
+    """Identify the constellation in an image; `max_stars=None` matches every detected star at once.
+
+    The 'incremental' mode adds stars brightest first instead of widening a fixed
+    set and gives up after `time_budget` seconds with its best answer so far; its
+    confidence is returned before the log (None in the other modes).
+    """
+    if mode not in MATCHER_MODES:
+        raise ValueError(f"Unknown matcher mode {mode!r}, expected one of {MATCHER_MODES}")
     log_str = ""
-    dots, log_img_processing = find_stars(import_path)
-    log_str += log_img_processing
-    df = pd.DataFrame(dots, columns=["x", "y"])
-    matches, log_matching = match_stars_to_catalogue(df, metrics, tree)
-    log_str += log_matching
-
-    short_name, output_list, log_lines = find_lines(matches, lines, dots)
-    log_str += log_lines
+    with telemetry.trace():
+        dots, log_img_processing = find_stars(source, debug_dir, threshold, downscale)
+        log_str += log_img_processing
+        matches, confidence, log_matching = identify_stars(dots, mode, max_stars, time_budget)
+        log_str += log_matching
+
+        with telemetry.stage('line_matching'):
+            short_name, output_list, log_lines = find_lines(matches, get_line_index(), dots)
+        log_str += log_lines
     full_name = constellation_names.get(short_name, short_name)
-    return full_name, output_list, log_str
+    return full_name, output_list, confidence, log_str
 
 # match('examples/inputs/image1.png', 'example.jpg')
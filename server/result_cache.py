@@ -0,0 +1,105 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from sqlite_store import execute
+
+
+def digest_key(sha256: str, *parts: str) -> str:
+    # Same bytes (by SHA-256) matched under the same mode and catalogue give the same result.
+    return ':'.join((sha256, *parts))
+
+
+class ResultCache:
+    """LRU cache of match results with an optional SQLite tier on disk.
+
+    Values must be JSON-serializable. The in-memory tier is bounded by
+    `max_entries`; the disk tier (when `path` is set) is shared by every
+    process pointing at the same file, survives restarts and keeps the
+    `max_disk_entries` most recently used results.
+    """
+
+    def __init__(self, max_entries: int = 256, path: str | None = None, max_disk_entries: int = 10000):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if path:
+            execute(self.path, "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "accessed_at REAL NOT NULL DEFAULT 0)")
+            try:
+                # Files written before results were evicted have no access times.
+                execute(self.path, "ALTER TABLE results ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
+            execute(self.path, "CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+
+    def _remember(self, key: str, value: dict):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str, usable=None) -> dict | None:
+        # `usable(value)` may turn down a cached result (e.g. its upload is gone):
+        # that counts as a miss and drops the entry.
+        with self._lock:
+            value = self._entries.get(key)
+        from_disk = False
+        if value is None and self.path:
+            row = execute(self.path, "SELECT value FROM results WHERE key = ?", (key,))
+            if row is not None:
+                value, from_disk = json.loads(row[0]), True
+
+        if value is not None and usable is not None and not usable(value):
+            self.discard(key)
+            value = None
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self._remember(key, value)
+            self.hits += 1
+            if from_disk:
+                self.disk_hits += 1
+        if self.path:
+            execute(self.path, "UPDATE results SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return value
+
+    def put(self, key: str, value: dict):
+        with self._lock:
+            self._remember(key, value)
+        if self.path:
+            execute(self.path, "INSERT OR REPLACE INTO results (key, value, accessed_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time()))
+            execute(self.path, "DELETE FROM results WHERE key IN "
+                    "(SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_disk_entries,))
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.path:
+            execute(self.path, "DELETE FROM results WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        disk_entries = execute(self.path, "SELECT COUNT(*) FROM results")[0] if self.path else 0
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'disk': bool(self.path),
+                'disk_entries': disk_entries,
+                'max_disk_entries': self.max_disk_entries,
+            }
@@ -1,28 +1,111 @@
-from flask import Flask, request, send_from_directory, jsonify
+from flask import Flask, Response, request, send_from_directory, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
+import base64
+import math
 import os
+import re
 import traceback
-from matcher import match  # Твоя функция обработки
+from catalogue import catalogue_version
+from concurrent.futures.process import BrokenProcessPool
+from jobs import JobQueue, QueueFull
+from functools import partial
+from matcher import draw_lines, is_preloaded, load_image, match, preload, warm_up, MATCHER_MODES  # Твоя функция обработки
+from result_cache import ResultCache, digest_key
+from upload_store import STORED_EXTENSIONS, UploadStore, UploadTooLarge, read_upload, sniff_extension
+import telemetry
+from tracking import SessionStore
 
 app = Flask(__name__)
 CORS(app)
 
 UPLOAD_FOLDER = os.path.join(os.getcwd(), "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# Служебные базы (кэш, задачи, сессии) лежат отдельно: всё в UPLOAD_FOLDER раздаётся через /uploads
+STATE_FOLDER = os.environ.get('STATE_FOLDER', os.path.join(os.getcwd(), "state"))
+os.makedirs(STATE_FOLDER, exist_ok=True)
+
+# Ограничение размера загрузки: всё, что больше, отклоняется с 413 ещё до чтения файла целиком
+MAX_UPLOAD_BYTES = int(float(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Файлы хранятся под хэшем содержимого; старые удаляются по возрасту и количеству
+upload_store = UploadStore(
+    UPLOAD_FOLDER,
+    max_files=int(os.environ.get('UPLOAD_MAX_FILES', 1000)) or None,
+    max_age=float(os.environ.get('UPLOAD_MAX_AGE_DAYS', 7)) * 86400 or None,
+)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+STORED_NAME = re.compile(r'[0-9a-f]{32}(%s)' % '|'.join(re.escape(ext) for ext in sorted(STORED_EXTENSIONS)))
+
+# Куда сохранять картинки с отмеченными звёздами (по умолчанию не сохраняются)
+DEBUG_DIR = os.environ.get('MATCH_DEBUG_DIR') or None
+
+# Лимит времени на сопоставление в режиме incremental, секунды (можно переопределить полем time_budget).
+# Без лимита поле из сотен звёзд сопоставлялось бы десятки секунд
+TIME_BUDGET = float(os.environ.get('MATCH_TIME_BUDGET') or 5)
+
+# Во сколько раз уменьшать кадр для поиска звёзд (1 = полное разрешение); ускоряет большие фото
+DOWNSCALE = int(os.environ.get('MATCH_DOWNSCALE', 1))
+
+# Асинхронная обработка: POST /api/upload?async=1 возвращает job id сразу.
+# MATCH_WORKERS и MATCH_QUEUE_DEPTH — на весь сервер: под gunicorn делятся между WEB_WORKERS воркерами
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+job_queue = JobQueue(
+    workers=max(1, int(os.environ.get('MATCH_WORKERS', os.cpu_count() or 1)) // WEB_WORKERS),
+    queue_depth=max(1, int(os.environ.get('MATCH_QUEUE_DEPTH', 16)) // WEB_WORKERS),
+    ttl=float(os.environ.get('MATCH_JOB_TTL', 600)),
+    initializer=preload,
+    # Общее хранилище статусов: под gunicorn опрос может прийти в другой воркер
+    store_path=os.environ.get('MATCH_JOB_STORE', os.path.join(STATE_FOLDER, 'jobs.sqlite')) or None,
+)
+
+# Кэш результатов по хэшу содержимого: повторная загрузка того же файла не пересчитывается
+CATALOGUE_VERSION = catalogue_version()
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_SIZE', 256)),
+    path=os.environ.get('RESULT_CACHE_PATH', os.path.join(STATE_FOLDER, 'result_cache.sqlite')) or None,
+    max_disk_entries=int(os.environ.get('RESULT_CACHE_DISK_SIZE', 10000)),
+)
+
+# Сессии слежения за видеопотоком: звёзды сопоставляются с предыдущим кадром, полный поиск — только при потере трека
+session_store = SessionStore(
+    ttl=float(os.environ.get('TRACKING_SESSION_TTL', 300)),
+    path=os.environ.get('TRACKING_SESSION_STORE', os.path.join(STATE_FOLDER, 'sessions.sqlite')) or None,
+)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_next_filename(extension):
-    counter = 1
-    while True:
-        filename = f"{counter}{extension}"
-        path = os.path.join(UPLOAD_FOLDER, filename)
-        if not os.path.exists(path):
-            return filename, path
-        counter += 1
+def is_requested(flag):
+    return request.values.get(flag, '').lower() in ('1', 'true', 'yes')
+
+def overlay_data_url(image, lines):
+    encoded = base64.b64encode(draw_lines(lines, image)).decode('ascii')
+    return f'data:image/jpeg;base64,{encoded}'
+
+def remember_result(cache_key, filename, result):
+    name, lines, confidence, str_log = result
+    result_cache.put(cache_key, {
+        'filename': filename,
+        'matched_name': name,
+        'lines': lines,
+        'confidence': confidence,
+        'log': str_log
+    })
+
+def with_confidence(response, confidence):
+    # Уверенность есть только у режима incremental
+    if confidence is not None:
+        response['confidence'] = round(confidence, 3)
+    return response
+
+def on_job_result(cache_key, filename, traced_result):
+    # Воркер возвращает (результат, тайминги); гистограммы /metrics живут в этом процессе
+    result, timings = traced_result
+    telemetry.record(timings)
+    remember_result(cache_key, filename, result)
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -38,35 +121,237 @@ def upload_file():
         if not allowed_file(file.filename):
             return jsonify({'error': 'File type not allowed'}), 400
 
-        ext = os.path.splitext(file.filename)[1].lower()
-        filename, save_path = get_next_filename(ext)
-
-        file.save(save_path)
-        print(f"Файл сохранён: {save_path}")
+        mode = request.form.get('matcher', 'brute')
+        if mode not in MATCHER_MODES:
+            return jsonify({'error': f'Unknown matcher mode: {mode}'}), 400
 
-        # Вызов функции match на сохранённом изображении
+        time_budget = TIME_BUDGET
+        if mode == 'incremental' and request.form.get('time_budget'):
+            try:
+                time_budget = float(request.form['time_budget'])
+            except ValueError:
+                time_budget = None
+            # nan означал бы «без лимита», а ноль или минус — остановку до первого треугольника
+            if time_budget is None or not math.isfinite(time_budget) or time_budget <= 0:
+                return jsonify({'error': 'time_budget must be a positive number of seconds'}), 400
 
-        # ДОБАВИЛ ЛОГИ В str_log!!!!!!!!!!!!!
         try:
-            name, lines, str_log = match(save_path)
-            print(f"Обработка завершена: {name}, линии: {lines}")
-        except Exception as e:
-            traceback.print_exc()
-            return jsonify({'error': f'Ошибка при обработке изображения: {str(e)}'}), 500
+            data, sha256 = read_upload(file.stream, MAX_UPLOAD_BYTES)
+        except UploadTooLarge as e:
+            return jsonify({'error': f'File too large: {str(e)}'}), 413
+        # Проверяем содержимое, а не только расширение
+        ext = sniff_extension(data)
+        if ext is None:
+            return jsonify({'error': 'File content is not a PNG, JPEG or GIF image'}), 400
+
+        cache_key = digest_key(sha256, mode, CATALOGUE_VERSION, str(DOWNSCALE),
+                               *([str(time_budget)] if mode == 'incremental' else []))
+        run_match = partial(match, mode=mode, debug_dir=DEBUG_DIR, time_budget=time_budget, downscale=DOWNSCALE)
+
+        # Результат без сохранённого файла (его удалила чистка) не отдаём: это промах
+        cached = result_cache.get(cache_key, lambda value: os.path.exists(os.path.join(UPLOAD_FOLDER, value['filename'])))
+        if cached is not None:
+            print(f"Результат взят из кэша: {cached['filename']}")
+            if is_requested('async'):
+                # Клиент ждёт job id: заводим уже завершённую задачу с результатом из кэша
+                job_id = job_queue.completed(
+                    ((cached['matched_name'], cached['lines'], cached.get('confidence'), cached['log']),
+                     {'stages': {}, 'counts': {}}))
+                return jsonify({
+                    'message': 'Файл принят в обработку',
+                    'filename': cached['filename'],
+                    'job_id': job_id,
+                    'status_url': f'/api/jobs/{job_id}',
+                    'cached': True
+                }), 202
+            response = with_confidence({
+                'message': 'Файл успешно обработан',
+                'filename': cached['filename'],
+                'matched_name': cached['matched_name'],
+                'lines': cached['lines'],
+                'cached': True
+            }, cached.get('confidence'))
+            if is_requested('overlay'):
+                response['overlay'] = overlay_data_url(load_image(data), cached['lines'])
+            return jsonify(response), 200
+
+        if is_requested('async'):
+            # Декодирует воркер
+            filename = upload_store.save(data, sha256, ext)
+            print(f"Файл сохранён: {filename}")
+            try:
+                job_id = job_queue.submit(
+                    telemetry.traced, run_match, data,
+                    on_result=lambda result: on_job_result(cache_key, filename, result)
+                )
+            except QueueFull as e:
+                return jsonify({'error': f'Сервер перегружен, попробуйте позже: {str(e)}'}), 429, {'Retry-After': '5'}
+            except BrokenProcessPool:
+                return jsonify({'error': 'Пул обработки недоступен, попробуйте позже'}), 503, {'Retry-After': '5'}
+            return jsonify({
+                'message': 'Файл принят в обработку',
+                'filename': filename,
+                'job_id': job_id,
+                'status_url': f'/api/jobs/{job_id}'
+            }), 202
+
+        # Декодируем один раз прямо из памяти; декодирование тоже попадает в тайминги (стадия decode)
+        with telemetry.trace() as trace:
+            try:
+                image = load_image(data)
+            except ValueError:
+                return jsonify({'error': 'Не удалось прочитать изображение'}), 400
+
+            filename = upload_store.save(data, sha256, ext)
+            print(f"Файл сохранён: {filename}")
+
+            # Вызов функции match на уже декодированном изображении
+
+            # ДОБАВИЛ ЛОГИ В str_log!!!!!!!!!!!!!
+            try:
+                name, lines, confidence, str_log = run_match(image)
+                print(f"Обработка завершена: {name}, линии: {lines}")
+                remember_result(cache_key, filename, (name, lines, confidence, str_log))
+            except Exception as e:
+                traceback.print_exc()
+                return jsonify({'error': f'Ошибка при обработке изображения: {str(e)}'}), 500
 
-        return jsonify({
+        response = with_confidence({
             'message': 'Файл успешно обработан',
             'filename': filename,
             'matched_name': name,
             'lines': lines
-        }), 200
+        }, confidence)
+        if is_requested('overlay'):
+            response['overlay'] = overlay_data_url(image, lines)
+        if is_requested('timings'):
+            response['timings'] = trace.as_dict()
+        return jsonify(response), 200
 
+    except HTTPException:
+        # Например, 413 от MAX_CONTENT_LENGTH: отдаём обработчику ошибок Flask
+        raise
     except Exception as e:
         traceback.print_exc()
         return jsonify({'error': f'Internal Server Error: {str(e)}'}), 500
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f'File too large: the limit is {MAX_UPLOAD_BYTES / (1024 * 1024):g} MB'}), 413
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    info = job_queue.status(job_id)
+    if info is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    response = {'job_id': job_id, 'status': info['status']}
+    if info['status'] == 'done':
+        (name, lines, confidence, str_log), timings = info['result']
+        response.update({'matched_name': name, 'lines': lines})
+        with_confidence(response, confidence)
+        if is_requested('timings'):
+            response['timings'] = timings
+    elif info['status'] == 'failed':
+        response['error'] = f"Ошибка при обработке изображения: {info['error']}"
+    return jsonify(response), 200
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    mode = request.values.get('matcher', 'brute')
+    if mode not in MATCHER_MODES:
+        return jsonify({'error': f'Unknown matcher mode: {mode}'}), 400
+    session_id = session_store.create(mode)
+    return jsonify({
+        'session_id': session_id,
+        'matcher': mode,
+        'frames_url': f'/api/sessions/{session_id}/frames'
+    }), 201
+
+@app.route('/api/sessions/<session_id>/frames', methods=['POST'])
+def session_frame(session_id):
+    session = session_store.load(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part in the request'}), 400
+
+    # Кадры не сохраняются на диск и не кэшируются: каждый обрабатывается один раз
+    try:
+        data, _ = read_upload(request.files['file'].stream, MAX_UPLOAD_BYTES)
+    except UploadTooLarge as e:
+        return jsonify({'error': f'File too large: {str(e)}'}), 413
+    if sniff_extension(data) is None:
+        return jsonify({'error': 'File content is not a PNG, JPEG or GIF image'}), 400
+    try:
+        image = load_image(data)
+    except ValueError:
+        return jsonify({'error': 'Не удалось прочитать изображение'}), 400
+
+    try:
+        result = session.update(image, downscale=DOWNSCALE)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'Ошибка при обработке изображения: {str(e)}'}), 500
+    session_store.save(session_id, session)
+
+    response = {key: result[key] for key in ('frame', 'matched_name', 'lines', 'tracked', 'tracking_confidence')}
+    if is_requested('overlay'):
+        response['overlay'] = overlay_data_url(image, result['lines'])
+    if is_requested('timings'):
+        response['timings'] = result['timings']
+    return jsonify(response), 200
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+def session_status(session_id):
+    session = session_store.load(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({
+        'session_id': session_id,
+        'matcher': session.mode,
+        'frames': session.frame,
+        'full_matches': session.full_matches,
+        'matched_stars': len(session.matches)
+    }), 200
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    if not session_store.delete(session_id):
+        return jsonify({'error': 'Session not found'}), 404
+    return '', 204
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Метрики только этого процесса (метка pid): под gunicorn каждый воркер считает своё
+    stats = result_cache.stats()
+    body = telemetry.render_prometheus({
+        'starfield_result_cache_hits_total': ('counter', stats['hits']),
+        'starfield_result_cache_misses_total': ('counter', stats['misses']),
+        'starfield_jobs_in_flight': ('gauge', job_queue.in_flight()),
+    })
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Готов, только когда каталог и индексы уже загружены (в проде это делает мастер gunicorn до fork)
+    if not is_preloaded():
+        return jsonify({'status': 'loading'}), 503
+    return jsonify({'status': 'ready', 'catalogue_version': CATALOGUE_VERSION}), 200
+
 @app.route('/uploads/<path:filename>', methods=['GET'])
 def download_file(filename):
+    # Отдаём только сохранённые картинки, а не всё содержимое папки
+    if not STORED_NAME.fullmatch(filename):
+        return jsonify({'error': 'File not found error'}), 404
     try:
         return send_from_directory(UPLOAD_FOLDER, filename)
     except Exception as e:
@@ -74,5 +359,7 @@ def download_file(filename):
         return jsonify({'error': 'File not found error'}), 404
 
 if __name__ == '__main__':
+    # Только для разработки; в проде: gunicorn -c gunicorn.conf.py server:app
+    warm_up()
     app.run(host='0.0.0.0', port=5000, debug=True)
 
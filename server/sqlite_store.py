@@ -0,0 +1,12 @@
+import sqlite3
+
+
+def execute(path: str, sql: str, params: tuple = ()):
+    # Runs one statement in its own connection and transaction and returns the
+    # first row, so processes sharing the file never hold a connection open.
+    db = sqlite3.connect(path, timeout=5)
+    try:
+        with db:
+            return db.execute(sql, params).fetchone()
+    finally:
+        db.close()
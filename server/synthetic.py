@@ -0,0 +1,247 @@
+import json
+import os
+from functools import lru_cache
+from itertools import combinations, permutations
+import numpy as np
+import cv2
+from scipy.optimize import least_squares
+from catalogue import CATALOGUE_DIR, Catalogue, catalogue_version, get_catalogue
+from constellation_lines import lines
+from matcher import calculate_2d_triangle_angles
+
+# The catalogue only stores each triangle's sorted angles, not star positions,
+# so a constellation's layout is rebuilt (up to similarity) from its triangles:
+# two anchor stars are fixed, every other star is placed from a triangle with
+# two already placed stars, and the angle assignment and side of the edge that
+# best agree with all catalogue triangles involving placed stars win. A few
+# passes of re-placing each star undo early wrong choices, and a robust
+# least-squares fit over every triangle polishes the result. Catalogue angles
+# are not perfectly planar-consistent, so each layout also reports its median
+# angle error and badly fitting constellations are left out of the benchmarks.
+
+REFINE_PASSES = 2
+CANDIDATE_PAIRS = 4
+MAX_LAYOUT_ERROR = 1.0  # median degrees of disagreement with the catalogue
+LAYOUTS_PATH = os.path.join(CATALOGUE_DIR, 'layouts.json')
+
+
+def _apex_candidates(p: np.ndarray, q: np.ndarray, angles: np.ndarray) -> np.ndarray:
+    # Every position of the third vertex given the angle triple, over all
+    # assignments of angles to p and q and both sides of the pq edge.
+    base = q - p
+    length = np.linalg.norm(base)
+    heading = np.arctan2(base[1], base[0])
+    candidates = []
+    for at_p, at_q, at_apex in permutations(np.radians(angles)):
+        if np.sin(at_apex) <= 1e-9:
+            continue
+        reach = length * np.sin(at_q) / np.sin(at_apex)
+        for side in (1, -1):
+            direction = heading + side * at_p
+            candidates.append(p + reach * np.array([np.cos(direction), np.sin(direction)]))
+    return np.array(candidates).reshape(-1, 2)
+
+
+def _errors(candidates: np.ndarray, hip: float, positions: dict[float, np.ndarray],
+            by_hip: dict[float, list[tuple[float, float, np.ndarray]]]) -> np.ndarray:
+    # Squared angle error of placing `hip` at each candidate, summed over the
+    # catalogue triangles it forms with already placed stars.
+    known = [(a, b, angles) for a, b, angles in by_hip[hip] if a in positions and b in positions]
+    if not known:
+        return np.zeros(len(candidates))
+    p_a = np.array([positions[a] for a, _, _ in known])
+    p_b = np.array([positions[b] for _, b, _ in known])
+    expected = np.array([angles for _, _, angles in known])
+    side_ab = np.linalg.norm(p_a - p_b, axis=1)[None, :]
+    side_bx = np.linalg.norm(p_b[None] - candidates[:, None], axis=2)
+    side_ax = np.linalg.norm(p_a[None] - candidates[:, None], axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        angles = calculate_2d_triangle_angles(np.broadcast_to(side_ab, side_bx.shape), side_bx, side_ax)
+    error = ((angles - expected[None]) ** 2).sum(axis=(1, 2))
+    return np.where(np.isfinite(error), error, np.inf)
+
+
+def _place(hip: float, positions: dict[float, np.ndarray],
+           by_hip: dict[float, list[tuple[float, float, np.ndarray]]]) -> tuple[float, np.ndarray] | None:
+    candidates = [_apex_candidates(positions[a], positions[b], angles)
+                  for a, b, angles in by_hip[hip] if a in positions and b in positions][:CANDIDATE_PAIRS]
+    if not candidates:
+        return None
+    candidates = np.vstack(candidates)
+    errors = _errors(candidates, hip, positions, by_hip)
+    best = int(np.argmin(errors))
+    return float(errors[best]), candidates[best]
+
+
+def _grow(positions: dict[float, np.ndarray], anchor: tuple[float, float], hips: list[float],
+          by_hip: dict[float, list[tuple[float, float, np.ndarray]]]) -> tuple[dict[float, np.ndarray], float]:
+    while True:
+        best = None
+        for hip in hips:
+            if hip in positions:
+                continue
+            placed = _place(hip, positions, by_hip)
+            if placed is not None and (best is None or placed[0] < best[0]):
+                best = (placed[0], hip, placed[1])
+        if best is None:
+            break
+        positions[best[1]] = best[2]
+
+    for _ in range(REFINE_PASSES):
+        for hip in list(positions):
+            if hip in anchor:
+                continue
+            current = positions.pop(hip)
+            placed = _place(hip, positions, by_hip)
+            positions[hip] = current if placed is None else placed[1]
+
+    total = sum(float(_errors(positions[hip][None], hip, positions, by_hip)[0]) for hip in positions)
+    return positions, total
+
+
+def _triangle_angles(points: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    a, b, c = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return calculate_2d_triangle_angles(
+            np.linalg.norm(a - b, axis=1), np.linalg.norm(b - c, axis=1), np.linalg.norm(a - c, axis=1))
+
+
+def _polish(positions: dict[float, np.ndarray], triangles: dict[frozenset, np.ndarray]) -> tuple[dict[float, np.ndarray], float]:
+    hips = list(positions)
+    column = {hip: i for i, hip in enumerate(hips)}
+    placed = [(triple, angles) for triple, angles in triangles.items() if triple <= positions.keys()]
+    vertices = np.array([[column[hip] for hip in triple] for triple, _ in placed])
+    expected = np.array([angles for _, angles in placed])
+
+    def residuals(flat: np.ndarray) -> np.ndarray:
+        return np.nan_to_num((_triangle_angles(flat.reshape(-1, 2), vertices) - expected).ravel(), nan=180.0)
+
+    start = np.concatenate([positions[hip] for hip in hips])
+    fitted = least_squares(residuals, start, loss='soft_l1', f_scale=0.5).x
+    if np.median(np.abs(residuals(fitted))) > np.median(np.abs(residuals(start))):
+        fitted = start
+    points = fitted.reshape(-1, 2)
+    return {hip: points[column[hip]] for hip in hips}, float(np.median(np.abs(residuals(fitted))))
+
+
+@lru_cache(maxsize=None)
+def _reconstruct(con: str, catalogue: Catalogue) -> tuple[tuple[tuple[float, tuple[float, float]], ...], float]:
+    rows = np.flatnonzero(catalogue.cons == con)
+    by_hip: dict[float, list[tuple[float, float, np.ndarray]]] = {}
+    pair_counts: dict[tuple[float, float], int] = {}
+    triangles: dict[frozenset, np.ndarray] = {}
+    for row in rows:
+        triple = tuple(sorted(catalogue.hips[row].tolist()))
+        if len(set(triple)) < 3:
+            continue
+        angles = catalogue.angles[row].astype(np.float64)
+        triangles[frozenset(triple)] = angles
+        for hip in triple:
+            a, b = (other for other in triple if other != hip)
+            by_hip.setdefault(hip, []).append((a, b, angles))
+        for pair in combinations(triple, 2):
+            pair_counts[pair] = pair_counts.get(pair, 0) + 1
+    if not pair_counts:
+        return (), np.inf
+    anchor = max(pair_counts, key=pair_counts.get)
+    hips = sorted(by_hip)
+
+    # The first apex fixes which angle sits at which anchor; try each assignment
+    # and keep the layout that disagrees least with the rest of the catalogue.
+    first_hip = next(hip for hip in hips if hip not in anchor and frozenset((*anchor, hip)) in triangles)
+    origin = {anchor[0]: np.array([0.0, 0.0]), anchor[1]: np.array([1.0, 0.0])}
+    best_positions, best_error = {}, np.inf
+    for candidate in _apex_candidates(*origin.values(), triangles[frozenset((*anchor, first_hip))])[::2]:
+        positions, error = _grow({**origin, first_hip: candidate}, anchor, hips, by_hip)
+        if len(positions) > len(best_positions) or (len(positions) == len(best_positions) and error < best_error):
+            best_positions, best_error = positions, error
+
+    positions, median_error = _polish(best_positions, triangles)
+    return tuple((hip, tuple(point)) for hip, point in positions.items()), median_error
+
+
+_saved_layouts: dict | None = None
+
+
+def _layout(con: str, catalogue: Catalogue | None) -> tuple[tuple[tuple[float, tuple[float, float]], ...], float]:
+    # Layouts of the default catalogue are saved next to it, keyed by catalogue
+    # version, since rebuilding all of them takes the better part of a minute.
+    global _saved_layouts
+    if catalogue is not None:
+        return _reconstruct(con, catalogue)
+
+    if _saved_layouts is None:
+        _saved_layouts = {'version': catalogue_version(), 'layouts': {}}
+        if os.path.exists(LAYOUTS_PATH):
+            with open(LAYOUTS_PATH) as f:
+                saved = json.load(f)
+            if saved.get('version') == _saved_layouts['version']:
+                _saved_layouts = saved
+
+    saved = _saved_layouts['layouts'].get(con)
+    if saved is None:
+        layout, error = _reconstruct(con, get_catalogue())
+        saved = {'error': error if np.isfinite(error) else None,
+                 'points': [[hip, *point] for hip, point in layout]}
+        _saved_layouts['layouts'][con] = saved
+        os.makedirs(os.path.dirname(LAYOUTS_PATH), exist_ok=True)
+        with open(LAYOUTS_PATH, 'w') as f:
+            json.dump(_saved_layouts, f)
+    error = np.inf if saved['error'] is None else saved['error']
+    return tuple((hip, (x, y)) for hip, x, y in saved['points']), error
+
+
+def reconstruct_constellation(con: str, catalogue: Catalogue | None = None) -> dict[float, np.ndarray]:
+    """Relative 2D positions of a constellation's catalogued stars, keyed by HIP."""
+    layout, _ = _layout(con, catalogue)
+    return {hip: np.array(point) for hip, point in layout}
+
+
+def layout_error(con: str, catalogue: Catalogue | None = None) -> float:
+    # Median angle error (degrees) of the reconstructed layout against the catalogue.
+    return _layout(con, catalogue)[1]
+
+
+def make_field(con: str, rng: np.random.Generator, size: int = 1000, rotation: float = 180.0,
+               scale: tuple[float, float] = (0.5, 0.8), noise: float = 0.0, fake_stars: int = 0,
+               catalogue: Catalogue | None = None) -> tuple[np.ndarray, dict[float, np.ndarray]]:
+    """Star coordinates of one constellation under a random similarity transform.
+
+    `rotation` is the maximum absolute rotation in degrees, `scale` the range of
+    the constellation's extent as a fraction of `size`, `noise` the positional
+    jitter in pixels. `fake_stars` random stars are appended after the real ones.
+    Returns an (n, 2) array and the HIP -> position map of the real stars.
+    """
+    positions = reconstruct_constellation(con, catalogue)
+    hips = list(positions)
+    points = np.array([positions[hip] for hip in hips])
+    points -= points.mean(axis=0)
+
+    theta = np.radians(rng.uniform(-rotation, rotation))
+    rotate = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    extent = np.ptp(points, axis=0).max() or 1.0
+    points = points @ rotate.T * (rng.uniform(*scale) * size / extent) + size / 2
+    points += rng.normal(0.0, noise, points.shape) if noise else 0.0
+
+    fakes = rng.uniform(0, size, (fake_stars, 2))
+    return np.vstack([points, fakes]), dict(zip(hips, points))
+
+
+def render_field(points: np.ndarray, size: int = 1000, radius: int = 3) -> np.ndarray:
+    img = np.zeros((size, size, 3), dtype=np.uint8)
+    for x, y in np.round(points).astype(int):
+        if 0 <= x < size and 0 <= y < size:
+            cv2.circle(img, (int(x), int(y)), radius, (255, 255, 255), -1)
+    return img
+
+
+def drawable_constellations(catalogue: Catalogue | None = None, min_stars: int = 4,
+                            max_error: float = MAX_LAYOUT_ERROR) -> list[str]:
+    # Constellations with enough stars to be told apart by shape and a layout
+    # that reproduces the catalogue angles well enough to be a fair test.
+    source = catalogue or get_catalogue()
+    cons, hips = source.cons, source.hips
+    return [con for con in source.constellations
+            if con in lines
+            and len(np.unique(hips[cons == con])) >= min_stars
+            and layout_error(con, catalogue) <= max_error]
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 3, 10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus exposition format."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Trace:
+    # Stage timings and item counts of one match, in the order they happened.
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+
+    def as_dict(self) -> dict:
+        return {'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+                'counts': dict(self.counts)}
+
+
+_stage_seconds: dict[str, Histogram] = {}
+_stage_items: dict[str, Histogram] = {}
+_registry_lock = threading.Lock()
+_current: ContextVar[Trace | None] = ContextVar('trace', default=None)
+
+
+def _histogram(registry: dict[str, Histogram], key: str, buckets: tuple[float, ...]) -> Histogram:
+    histogram = registry.get(key)
+    if histogram is None:
+        with _registry_lock:
+            histogram = registry.setdefault(key, Histogram(buckets))
+    return histogram
+
+
+def record(timings: dict):
+    # Adds a finished trace (Trace.as_dict) to this process's histograms.
+    for stage, seconds in timings.get('stages', {}).items():
+        _histogram(_stage_seconds, stage, SECONDS_BUCKETS).observe(seconds)
+    for item, value in timings.get('counts', {}).items():
+        _histogram(_stage_items, item, COUNT_BUCKETS).observe(value)
+
+
+@contextmanager
+def trace():
+    # Collects every stage/count reported inside the block; nested traces join the outer one.
+    current = _current.get()
+    if current is not None:
+        yield current
+        return
+    current = Trace()
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        record(current.as_dict())
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        current = _current.get()
+        if current is None:
+            _histogram(_stage_seconds, name, SECONDS_BUCKETS).observe(elapsed)
+        else:
+            current.stages[name] = current.stages.get(name, 0.0) + elapsed
+
+
+def count(name: str, value: int):
+    current = _current.get()
+    if current is None:
+        _histogram(_stage_items, name, COUNT_BUCKETS).observe(value)
+    else:
+        current.counts[name] = current.counts.get(name, 0) + value
+
+
+def traced(fn, *args):
+    # Runs fn inside a trace and returns (result, timings), e.g. in a worker process
+    # whose histograms the web process cannot see.
+    with trace() as current:
+        result = fn(*args)
+    return result, current.as_dict()
+
+
+def reset():
+    # Forgets everything recorded so far, e.g. warm-up matches run before workers fork.
+    with _registry_lock:
+        _stage_seconds.clear()
+        _stage_items.clear()
+
+
+def render_prometheus(extra: dict[str, tuple[str, float]] | None = None) -> str:
+    # `extra` maps metric names to (type, value), e.g. {'x_total': ('counter', 3)}.
+    # Every process keeps its own histograms, so each series is labelled with the
+    # pid that produced it; with several web workers a scrape only shows the one
+    # that answered, and queries should aggregate over pid.
+    pid = f'pid="{os.getpid()}"'
+    lines = [
+        '# HELP starfield_stage_seconds Time spent in each match stage.',
+        '# TYPE starfield_stage_seconds histogram',
+    ]
+    for stage_name, histogram in sorted(_stage_seconds.items()):
+        lines.extend(histogram.render('starfield_stage_seconds', f'{pid},stage="{stage_name}"'))
+    lines += [
+        '# HELP starfield_stage_items Items handled per match (stars, triangles, votes).',
+        '# TYPE starfield_stage_items histogram',
+    ]
+    for item, histogram in sorted(_stage_items.items()):
+        lines.extend(histogram.render('starfield_stage_items', f'{pid},item="{item}"'))
+    for name, (kind, value) in (extra or {}).items():
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name}{{{pid}}} {value}')
+    return '\n'.join(lines) + '\n'
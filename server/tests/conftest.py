@@ -0,0 +1,8 @@
+import os
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES_DIR = os.path.join(SERVER_DIR, '..', 'examples', 'inputs')
+
+# The server modules import each other by plain name, as when run from server/.
+sys.path.insert(0, SERVER_DIR)
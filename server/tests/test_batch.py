@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import shutil
+
+from batch import main, match_many, processed_hashes
+from catalogue import catalogue_version
+from conftest import EXAMPLES_DIR
+
+IMAGE = os.path.join(EXAMPLES_DIR, 'image4.png')
+
+
+def sha256_of(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_match_many_skips_known_and_repeated_images(tmp_path):
+    copy = tmp_path / 'copy.png'
+    shutil.copy(IMAGE, copy)
+    other = os.path.join(EXAMPLES_DIR, 'image1.png')
+    sources = [IMAGE, str(copy), other, str(tmp_path / 'missing.png')]
+
+    records = list(match_many(sources, workers=1, skip_hashes={sha256_of(other)}))
+    by_source = {record['source']: record for record in records}
+    assert len(records) == 4
+    assert by_source[IMAGE]['matched_name'] == 'UMa'
+    assert by_source[IMAGE]['catalogue_version'] == catalogue_version()
+    assert by_source[str(copy)]['skipped'] and by_source[other]['skipped']
+    assert 'error' in by_source[str(tmp_path / 'missing.png')]
+
+
+def test_processed_hashes_keeps_successes_of_this_mode_and_catalogue(tmp_path):
+    version = catalogue_version()
+    results = tmp_path / 'results.jsonl'
+    results.write_text('\n'.join([
+        json.dumps({'sha256': 'a', 'mode': 'brute', 'catalogue_version': version, 'matched_name': 'UMa'}),
+        json.dumps({'sha256': 'b', 'mode': 'hash', 'catalogue_version': version, 'matched_name': 'UMa'}),
+        json.dumps({'sha256': 'c', 'mode': 'brute', 'catalogue_version': 'old', 'matched_name': 'UMa'}),
+        json.dumps({'sha256': 'd', 'mode': 'brute', 'catalogue_version': version, 'error': 'boom'}),
+        '{"sha256": "e", "mode": "brute", "catal',
+    ]) + '\n')
+    assert processed_hashes(str(results), 'brute') == {'a'}
+    assert processed_hashes(str(tmp_path / 'none.jsonl'), 'brute') == set()
+
+
+def test_resume_appends_only_new_images(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    shutil.copy(IMAGE, images / 'a.png')
+    output = tmp_path / 'results.jsonl'
+
+    main([str(images), '-o', str(output), '-j', '1'])
+    shutil.copy(os.path.join(EXAMPLES_DIR, 'image1.png'), images / 'b.png')
+    main([str(images), '-o', str(output), '-j', '1', '--resume'])
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [os.path.basename(record['source']) for record in records] == ['a.png', 'b.png']
+    assert [record['matched_name'] for record in records] == ['UMa', 'cancer']
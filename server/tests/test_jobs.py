@@ -0,0 +1,59 @@
+import os
+import signal
+import time
+
+import pytest
+
+from jobs import JobQueue, QueueFull
+
+
+def crash():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def wait_for(queue: JobQueue, job_id: str, timeout: float = 30.0) -> dict:
+    deadline = time.time() + timeout
+    while (info := queue.status(job_id))['status'] in ('queued', 'running'):
+        assert time.time() < deadline, f"job {job_id} still {info['status']}"
+        time.sleep(0.05)
+    return info
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(workers=1, queue_depth=1, store_path=str(tmp_path / 'jobs.sqlite'))
+    yield queue
+    queue.shutdown()
+
+
+def test_finished_jobs_report_their_result(queue, tmp_path):
+    results = []
+    job_id = queue.submit(pow, 2, 10, on_result=results.append)
+    assert wait_for(queue, job_id)['result'] == 1024
+    assert results == [1024]
+    # Another process sharing the store sees the same job.
+    other = JobQueue(workers=1, queue_depth=1, store_path=str(tmp_path / 'jobs.sqlite'))
+    assert other.status(job_id)['status'] == 'done'
+    assert other.status(job_id)['result'] == 1024
+
+
+def test_full_queue_pushes_back(queue):
+    running = queue.submit(time.sleep, 1.0)
+    waiting = queue.submit(time.sleep, 0.0)
+    with pytest.raises(QueueFull):
+        queue.submit(time.sleep, 0.0)
+    assert queue.in_flight() == 2
+    wait_for(queue, running)
+    wait_for(queue, waiting)
+    assert wait_for(queue, queue.submit(pow, 3, 2))['result'] == 9
+
+
+def test_pool_is_replaced_after_a_worker_dies(queue):
+    assert wait_for(queue, queue.submit(crash))['status'] == 'failed'
+    assert wait_for(queue, queue.submit(pow, 2, 5))['result'] == 32
+
+
+def test_completed_jobs_are_done_at_once(queue):
+    job_id = queue.completed({'cached': True})
+    assert queue.status(job_id)['status'] == 'done'
+    assert queue.status(job_id)['result'] == {'cached': True}
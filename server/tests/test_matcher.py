@@ -0,0 +1,118 @@
+import glob
+import os
+from collections import Counter
+from itertools import combinations
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import EXAMPLES_DIR
+from catalogue import get_catalogue
+import matcher
+import synthetic
+from line_index import get_line_index
+from matcher import (calculate_2d_triangle_angles, detect_stars, find_lines, find_stars, identify_stars, match,
+                     match_stars_to_catalogue, MATCHER_MODES, MAX_STARS, MAX_WIDENING)
+
+EXAMPLES = sorted(glob.glob(os.path.join(EXAMPLES_DIR, 'image*.png')))
+EXPECTED_NAMES = {
+    'image1.png': 'cancer',
+    'image2.png': 'cepheus',
+    'image3.png': 'UMi',
+    'image4.png': 'UMa',
+    'image5.png': 'aquila',
+    'image6.png': 'perseus',
+    'image7.png': 'grus',
+    'image8.png': 'Vol',
+}
+
+
+def reference_matches(coords: np.ndarray) -> dict[int, float]:
+    # The original per-star loop: every triangle a star is part of votes with the
+    # HIPs of its two nearest catalogue triangles; most votes wins, then the
+    # smallest mean distance, and a HIP is given to one star only.
+    catalogue = get_catalogue()
+    used_hips: set[float] = set()
+    matches = {}
+    for i in range(len(coords)):
+        candidates, distances = [], {}
+        for j, k in combinations(range(len(coords)), 2):
+            if i in (j, k):
+                continue
+            a, b, c = coords[i], coords[j], coords[k]
+            angles = calculate_2d_triangle_angles(np.linalg.norm(a - b), np.linalg.norm(b - c), np.linalg.norm(a - c))
+            dist, ind = catalogue.tree.query([angles], k=2)
+            for row, d in zip(ind[0], dist[0]):
+                for hip in catalogue.hips[row]:
+                    if hip not in used_hips:
+                        candidates.append(hip)
+                        distances.setdefault(hip, []).append(d)
+        if not candidates:
+            continue
+        ranked = Counter(candidates).most_common()
+        top = [hip for hip, votes in ranked if votes == ranked[0][1]]
+        best = min(top, key=lambda hip: np.mean(distances[hip]))
+        matches[i] = float(best)
+        used_hips.add(best)
+    return matches
+
+
+@pytest.mark.parametrize('path', EXAMPLES, ids=os.path.basename)
+def test_vectorized_matching_agrees_with_reference(path):
+    dots, _ = find_stars(path)
+    coords = np.array(dots)
+    matches, _ = match_stars_to_catalogue(pd.DataFrame(coords, columns=['x', 'y']), get_catalogue())
+    assert matches == reference_matches(coords)
+
+
+@pytest.mark.parametrize('mode', MATCHER_MODES)
+@pytest.mark.parametrize('path', EXAMPLES, ids=os.path.basename)
+def test_every_mode_identifies_the_examples(path, mode):
+    name, lines, _, _ = match(path, mode)
+    assert name == EXPECTED_NAMES[os.path.basename(path)]
+    assert lines
+
+
+NOISY_FIELDS = ['Aql', 'Cas', 'Cep', 'CrB', 'Crv', 'Cyg', 'Gem', 'Leo']
+MODE_MATCHERS = {'brute': 'match_stars_to_catalogue', 'hash': 'match_stars_by_invariants',
+                 'scoped': 'match_stars_by_constellation'}
+
+
+@pytest.mark.parametrize('mode', MODE_MATCHERS)
+def test_widening_stops_before_faint_noise(mode, monkeypatch):
+    # Real stars come first and 300 fainter fakes follow; widening must neither
+    # reach the fakes' level of noise nor lose the constellation to it.
+    inner = getattr(matcher, MODE_MATCHERS[mode])
+    sizes = []
+
+    def spy(df, *args, **kwargs):
+        sizes.append(len(df))
+        return inner(df, *args, **kwargs)
+
+    monkeypatch.setattr(matcher, MODE_MATCHERS[mode], spy)
+    correct = 0
+    for seed, con in enumerate(NOISY_FIELDS):
+        points, _ = synthetic.make_field(con, np.random.default_rng(seed), noise=0.5, fake_stars=300)
+        dots = [tuple(point) for point in points]
+        matches, _, _ = identify_stars(dots, mode)
+        correct += find_lines(matches, get_line_index(), dots)[0] == con
+    assert max(sizes) <= MAX_WIDENING * MAX_STARS
+    assert correct >= len(NOISY_FIELDS) - 1
+
+
+def test_tiled_detection_agrees_with_single_pass():
+    rng = np.random.default_rng(0)
+    img = np.zeros((700, 900, 3), dtype=np.uint8)
+    # Random stars plus a few straddling the seams of 128-pixel tiles.
+    points = [tuple(p) for p in rng.integers(5, (895, 695), size=(120, 2))]
+    points += [(128, 300), (256, 256), (400, 384), (639, 511)]
+    for (x, y), radius in zip(points, rng.integers(1, 4, size=len(points))):
+        cv2.circle(img, (int(x), int(y)), int(radius), (255, 255, 255), -1)
+
+    whole = detect_stars(img, tile_size=4096)
+    tiled = detect_stars(img, tile_size=128, workers=4)
+    key = ['x', 'y', 'area', 'flux']
+    pd.testing.assert_frame_equal(whole.sort_values(key).reset_index(drop=True),
+                                  tiled.sort_values(key).reset_index(drop=True))
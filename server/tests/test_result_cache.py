@@ -0,0 +1,46 @@
+import sqlite3
+
+from result_cache import ResultCache
+
+
+def test_disk_tier_evicts_the_least_recently_used(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ResultCache(max_entries=1, path=path, max_disk_entries=2)
+    cache.put('a', {'n': 1})
+    cache.put('b', {'n': 2})
+    assert cache.get('a') == {'n': 1}  # now more recent than 'b'
+    cache.put('c', {'n': 3})
+
+    fresh = ResultCache(path=path, max_disk_entries=2)
+    assert fresh.get('b') is None
+    assert fresh.get('a') == {'n': 1} and fresh.get('c') == {'n': 3}
+    assert fresh.stats()['disk_entries'] == 2
+
+
+def test_rejected_results_count_as_misses(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'cache.sqlite'))
+    cache.put('a', {'filename': 'gone.png'})
+    assert cache.get('a', lambda value: False) is None
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['disk_entries']) == (0, 2, 0)
+
+
+def test_hits_are_counted_per_tier(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    ResultCache(path=path).put('a', {'n': 1})
+    cache = ResultCache(path=path)
+    assert cache.get('a') == cache.get('a') == {'n': 1}
+    stats = cache.stats()
+    assert (stats['hits'], stats['disk_hits'], stats['misses']) == (2, 1, 0)
+
+
+def test_opens_files_written_without_access_times(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.execute("INSERT INTO results VALUES ('old', '{\"n\": 0}')")
+    cache = ResultCache(path=path, max_disk_entries=1)
+    cache.put('new', {'n': 1})
+    assert cache.get('old') is None
+    assert cache.get('new') == {'n': 1}
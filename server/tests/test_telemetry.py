@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import telemetry
+from telemetry import Histogram
+
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    telemetry.reset()
+    yield
+    telemetry.reset()
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+    assert histogram.render('x', 'a="b"') == [
+        'x_bucket{a="b",le="1"} 2',
+        'x_bucket{a="b",le="10"} 3',
+        'x_bucket{a="b",le="+Inf"} 4',
+        'x_sum{a="b"} 56.5',
+        'x_count{a="b"} 4',
+    ]
+
+
+def test_nested_traces_join_the_outer_one():
+    with telemetry.trace() as outer:
+        with telemetry.stage('decode'):
+            pass
+        with telemetry.trace() as inner:
+            telemetry.count('stars', 4)
+            with telemetry.stage('decode'):
+                pass
+        telemetry.count('stars', 3)
+    assert inner is outer
+    assert outer.counts == {'stars': 7}
+    assert list(outer.stages) == ['decode']
+    # Recorded once, when the outer trace ends.
+    body = telemetry.render_prometheus()
+    assert f'starfield_stage_items_count{{pid="{os.getpid()}",item="stars"}} 1' in body
+    assert f'starfield_stage_seconds_count{{pid="{os.getpid()}",stage="decode"}} 1' in body
+
+
+def test_traced_returns_the_timings_with_the_result():
+    def work():
+        telemetry.count('triangles_evaluated', 10)
+        return 'done'
+
+    result, timings = telemetry.traced(work)
+    assert result == 'done'
+    assert timings == {'stages': {}, 'counts': {'triangles_evaluated': 10}}
+
+
+def test_render_prometheus_labels_series_by_pid():
+    body = telemetry.render_prometheus({'x_total': ('counter', 3)})
+    assert f'x_total{{pid="{os.getpid()}"}} 3' in body
+    assert '# TYPE x_total counter' in body
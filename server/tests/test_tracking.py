@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import synthetic
+import tracking
+from tracking import SessionStore, TrackingSession, track_stars
+
+
+@pytest.fixture
+def frames(monkeypatch):
+    # Frames are given as star lists, in place of images, to skip detection.
+    monkeypatch.setattr(tracking, 'find_stars', lambda source, downscale=1: ([tuple(p) for p in source], ""))
+    points, _ = synthetic.make_field('UMa', np.random.default_rng(0))
+    return points
+
+
+def test_track_stars_follows_a_shifted_field():
+    rng = np.random.default_rng(1)
+    previous = rng.uniform(0, 1000, (30, 2))
+    order = rng.permutation(30)
+    current = previous[order] + (12.0, -7.0) + rng.normal(0, 0.3, (30, 2))
+    pairs, shift = track_stars(previous, current)
+    assert pairs == {int(i): j for j, i in enumerate(order)}
+    np.testing.assert_allclose(shift, (12.0, -7.0), atol=0.5)
+
+
+def test_track_stars_without_stars():
+    pairs, shift = track_stars(np.empty((0, 2)), np.array([[1.0, 2.0]]))
+    assert pairs == {} and not shift.any()
+
+
+def test_session_tracks_a_moving_field(frames):
+    session = TrackingSession('brute')
+    first = session.update(frames)
+    assert not first['tracked'] and first['matched_name'] == 'UMa'
+    second = session.update(frames + (8.0, 5.0))
+    assert second['tracked'] and second['matched_name'] == 'UMa'
+    assert second['lines'] == [[(x + 8.0, y + 5.0) for x, y in line] for line in first['lines']]
+    assert session.full_matches == 1
+
+
+def test_session_confidence_is_measured_against_the_full_match(frames):
+    # Losing a star or two per frame must not stay "tracked" down to a handful,
+    # and the whole figure coming back must be matched again in full.
+    session = TrackingSession('brute')
+    first = session.update(frames)
+    assert session.reference == len(frames) == 7
+    results = [session.update(frames[:keep]) for keep in (5, 4, 3, 7)]
+    assert results[0]['tracked'] and results[0]['tracking_confidence'] == round(5 / 7, 3)
+    assert not results[1]['tracked']
+    assert not results[3]['tracked']
+    assert results[3]['lines'] == first['lines']
+
+
+def test_session_reidentifies_when_new_stars_appear(frames):
+    session = TrackingSession('brute')
+    session.update(frames)
+    crowded = np.vstack([frames, np.random.default_rng(2).uniform(0, 1000, (2 * len(frames), 2))])
+    result = session.update(crowded)
+    assert not result['tracked']
+    assert session.full_matches == 2
+
+
+def test_session_state_round_trips(frames):
+    store = SessionStore()
+    session_id = store.create('hash')
+    session = store.load(session_id)
+    session.update(frames)
+    store.save(session_id, session)
+    restored = store.load(session_id)
+    assert restored.state == session.state
+    assert store.delete(session_id) and store.load(session_id) is None
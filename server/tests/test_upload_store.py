@@ -0,0 +1,95 @@
+import importlib
+import io
+import os
+import time
+
+import pytest
+
+from upload_store import UploadStore, UploadTooLarge, read_upload, sniff_extension
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 64
+
+
+def test_read_upload_stops_past_the_limit():
+    data, sha256 = read_upload(io.BytesIO(b'x' * 100), max_bytes=100)
+    assert len(data) == 100 and len(sha256) == 64
+    with pytest.raises(UploadTooLarge):
+        read_upload(io.BytesIO(b'x' * 101), max_bytes=100)
+
+
+@pytest.mark.parametrize('head, ext', [
+    (PNG, '.png'),
+    (b'\xff\xd8\xff\xe0' + b'\0' * 16, '.jpg'),
+    (b'GIF89a' + b'\0' * 16, '.gif'),
+    (b'<svg xmlns="http://www.w3.org/2000/svg"/>', None),
+    (b'PNG\r\n', None),
+    (b'', None),
+])
+def test_sniff_extension_goes_by_magic_bytes(head, ext):
+    assert sniff_extension(head) == ext
+
+
+def test_save_is_content_addressed(tmp_path):
+    store = UploadStore(str(tmp_path))
+    filename = store.save(PNG, 'ab' * 32, '.png')
+    assert filename == 'ab' * 16 + '.png'
+    assert store.save(PNG, 'ab' * 32, '.png') == filename
+    assert os.listdir(tmp_path) == [filename]
+
+
+def test_sweep_evicts_by_count_and_age_only_images(tmp_path):
+    store = UploadStore(str(tmp_path), max_files=2, max_age=3600, sweep_interval=3600)
+    now = time.time()
+    for i, age in enumerate((10, 20, 30, 7200)):
+        path = tmp_path / f'{i:032x}.png'
+        path.write_bytes(PNG)
+        os.utime(path, (now - age, now - age))
+    for name in ('result_cache.sqlite', '.upload-x.tmp', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'keep')
+        os.utime(tmp_path / name, (now - 7200, now - 7200))
+
+    assert store.sweep() == 2
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        f'{0:032x}.png', f'{1:032x}.png', 'result_cache.sqlite', '.upload-x.tmp', 'notes.txt'])
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # server.py keeps uploads under the working directory it is imported from.
+    root = tmp_path_factory.mktemp('server')
+    previous = os.getcwd()
+    os.chdir(root)
+    os.environ['STATE_FOLDER'] = str(root / 'state')
+    try:
+        server = importlib.import_module('server')
+    finally:
+        os.chdir(previous)
+        del os.environ['STATE_FOLDER']
+    yield server, server.app.test_client()
+    server.job_queue.shutdown()
+
+
+def test_upload_rejects_content_that_is_not_an_image(client):
+    _, test_client = client
+    response = test_client.post('/api/upload', data={'file': (io.BytesIO(b'<html></html>'), 'star.png')})
+    assert response.status_code == 400
+    assert 'not a PNG' in response.json['error']
+
+
+def test_upload_over_the_limit_is_refused(client, monkeypatch):
+    server, test_client = client
+    monkeypatch.setattr(server, 'MAX_UPLOAD_BYTES', 32)
+    response = test_client.post('/api/upload', data={'file': (io.BytesIO(PNG), 'star.png')})
+    assert response.status_code == 413
+
+
+def test_uploads_serves_stored_images_only(client):
+    server, test_client = client
+    stored = 'cd' * 16 + '.png'
+    for name in (stored, 'notes.txt', 'result_cache.sqlite', 'CD' * 16 + '.png'):
+        with open(os.path.join(server.UPLOAD_FOLDER, name), 'wb') as f:
+            f.write(PNG)
+
+    assert test_client.get(f'/uploads/{stored}').status_code == 200
+    for name in ('notes.txt', 'result_cache.sqlite', 'CD' * 16 + '.png', f'../{stored}', stored + '.bak'):
+        assert test_client.get(f'/uploads/{name}').status_code == 404
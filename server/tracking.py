@@ -0,0 +1,175 @@
+import json
+import threading
+import time
+import uuid
+
+import numpy as np
+from scipy.spatial import cKDTree
+import telemetry
+from data.constellation import constellation_names
+from line_index import get_line_index
+from sqlite_store import execute
+from matcher import find_lines, find_stars, format_log_message, identify_stars, ImageSource, MATCHER_MODES
+
+# Between consecutive frames the whole field moves together, so stars are paired
+# by mutual nearest neighbour twice: first within MAX_SHIFT pixels to estimate
+# the frame's median shift, then within TRACK_TOLERANCE of their shifted
+# positions. Matches carry over to the paired stars. The frame is identified
+# from scratch when fewer than MIN_TRACKED of the stars the last full match
+# found (or fewer than MIN_TRACKED_STARS) can still be followed, or when more
+# than MAX_NEW_STARS of the frame's stars were not in the previous one.
+MAX_SHIFT = 40.0
+TRACK_TOLERANCE = 4.0
+MIN_TRACKED = 0.6
+MIN_TRACKED_STARS = 3
+MAX_NEW_STARS = 0.5
+
+
+def _mutual_nearest(previous: np.ndarray, current: np.ndarray, radius: float) -> dict[int, int]:
+    forward_dist, forward = cKDTree(current).query(previous, distance_upper_bound=radius)
+    _, backward = cKDTree(previous).query(current, distance_upper_bound=radius)
+    return {i: int(j) for i, (j, dist) in enumerate(zip(forward, forward_dist))
+            if np.isfinite(dist) and backward[j] == i}
+
+
+def track_stars(previous: np.ndarray, current: np.ndarray, max_shift: float = MAX_SHIFT,
+                tolerance: float = TRACK_TOLERANCE) -> tuple[dict[int, int], np.ndarray]:
+    """Pairs stars of the previous frame with stars of the current one.
+
+    Returns previous index -> current index and the estimated (dx, dy) shift.
+    """
+    shift = np.zeros(2)
+    if len(previous) == 0 or len(current) == 0:
+        return {}, shift
+    coarse = _mutual_nearest(previous, current, max_shift)
+    if not coarse:
+        return {}, shift
+    pairs = np.array(list(coarse.items()))
+    shift = np.median(current[pairs[:, 1]] - previous[pairs[:, 0]], axis=0)
+    return _mutual_nearest(previous + shift, current, tolerance), shift
+
+
+class TrackingSession:
+    """Identifies a constellation across successive frames of one camera.
+
+    State is plain JSON (see `state`), so sessions can live in any store.
+    """
+
+    def __init__(self, mode: str = 'brute', state: dict | None = None):
+        if mode not in MATCHER_MODES:
+            raise ValueError(f"Unknown matcher mode {mode!r}, expected one of {MATCHER_MODES}")
+        state = state or {}
+        self.mode = state.get('mode', mode)
+        self.frame = state.get('frame', 0)
+        self.stars = np.array(state.get('stars', []), dtype=float).reshape(-1, 2)
+        self.matches = {int(i): hip for i, hip in state.get('matches', {}).items()}
+        self.full_matches = state.get('full_matches', 0)
+        self.reference = state.get('reference', 0)
+
+    @property
+    def state(self) -> dict:
+        return {
+            'mode': self.mode,
+            'frame': self.frame,
+            'stars': self.stars.tolist(),
+            'matches': {str(i): hip for i, hip in self.matches.items()},
+            'full_matches': self.full_matches,
+            'reference': self.reference,
+        }
+
+    def update(self, source: ImageSource, downscale: int = 1) -> dict:
+        # Processes the next frame and returns what the upload API reports for an image.
+        log_str = ""
+        with telemetry.trace() as trace:
+            dots, log_stars = find_stars(source, downscale=downscale)
+            log_str += log_stars
+            current = np.array(dots, dtype=float).reshape(-1, 2)
+
+            with telemetry.stage('tracking'):
+                pairs, shift = track_stars(self.stars, current)
+            matches = {pairs[i]: hip for i, hip in self.matches.items() if i in pairs}
+            confidence = len(matches) / self.reference if self.reference else 0.0
+            new_stars = (len(current) - len(pairs)) / len(current) if len(current) else 0.0
+            tracked = (confidence >= MIN_TRACKED and len(matches) >= MIN_TRACKED_STARS
+                       and new_stars <= MAX_NEW_STARS)
+            if tracked:
+                log_str += format_log_message(
+                    f"Tracked {len(matches)} of {self.reference} matched stars, shift ({shift[0]:.1f}, {shift[1]:.1f}).")
+            else:
+                if self.frame:
+                    log_str += format_log_message(
+                        f"Tracking confidence {confidence:.2f} with {new_stars:.0%} new stars, "
+                        f"matching the frame from scratch.")
+                matches, _, log_matching = identify_stars(dots, self.mode)
+                log_str += log_matching
+                self.full_matches += 1
+                self.reference = len(matches)
+
+            with telemetry.stage('line_matching'):
+                short_name, lines, log_lines = find_lines(matches, get_line_index(), dots)
+            log_str += log_lines
+
+        self.frame += 1
+        self.stars = current
+        self.matches = matches
+        return {
+            'frame': self.frame,
+            'matched_name': constellation_names.get(short_name, short_name),
+            'lines': lines,
+            'tracked': tracked,
+            'tracking_confidence': round(confidence, 3),
+            'stars': len(dots),
+            'timings': trace.as_dict(),
+            'log': log_str,
+        }
+
+
+class SessionStore:
+    """Tracking session states, kept for `ttl` seconds after their last frame.
+
+    Without `path` they live in this process only; with it they are kept in
+    SQLite so any web worker can continue a session.
+    """
+
+    def __init__(self, ttl: float = 300.0, path: str | None = None):
+        self.ttl = ttl
+        self.path = path
+        self._states: dict[str, tuple[dict, float]] = {}
+        self._lock = threading.Lock()
+        if path:
+            execute(self.path, "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, "
+                    "state TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def create(self, mode: str = 'brute') -> str:
+        session_id = uuid.uuid4().hex
+        self.save(session_id, TrackingSession(mode))
+        return session_id
+
+    def load(self, session_id: str) -> TrackingSession | None:
+        now = time.time()
+        if self.path:
+            execute(self.path, "DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+            row = execute(self.path, "SELECT state FROM sessions WHERE session_id = ?", (session_id,))
+            return None if row is None else TrackingSession(state=json.loads(row[0]))
+        with self._lock:
+            for expired in [key for key, (_, updated) in self._states.items() if now - updated > self.ttl]:
+                del self._states[expired]
+            entry = self._states.get(session_id)
+        return None if entry is None else TrackingSession(state=entry[0])
+
+    def save(self, session_id: str, session: TrackingSession):
+        now = time.time()
+        if self.path:
+            execute(self.path, "INSERT OR REPLACE INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?)",
+                    (session_id, json.dumps(session.state), now))
+            return
+        with self._lock:
+            self._states[session_id] = (session.state, now)
+
+    def delete(self, session_id: str) -> bool:
+        if self.path:
+            existed = execute(self.path, "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)) is not None
+            execute(self.path, "DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            return existed
+        with self._lock:
+            return self._states.pop(session_id, None) is not None
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import BinaryIO
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of every format the matcher accepts, mapped to the extension
+# the file is stored under.
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+
+STORED_EXTENSIONS = {ext for _, ext in MAGIC_NUMBERS}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def sniff_extension(head: bytes) -> str | None:
+    for magic, ext in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return ext
+    return None
+
+
+def read_upload(stream: BinaryIO, max_bytes: int) -> tuple[bytes, str]:
+    # Returns the upload's bytes and SHA-256, hashed as they are read; raises
+    # UploadTooLarge as soon as `max_bytes` is exceeded. Decoding and storing
+    # both need the whole file in memory, so it is not spooled anywhere else.
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    while chunk := stream.read(CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(f"upload exceeds {max_bytes} bytes")
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b''.join(chunks), digest.hexdigest()
+
+
+class UploadStore:
+    """Content-addressed upload folder with a retention policy.
+
+    Files are named after their SHA-256, written to a temporary name and
+    renamed into place, so concurrent workers never clash and a repeated
+    upload reuses the stored file. Files older than `max_age` seconds, and the
+    oldest ones beyond `max_files`, are evicted by a sweep that runs at most
+    once every `sweep_interval` seconds.
+    """
+
+    def __init__(self, folder: str, max_files: int | None = None, max_age: float | None = None,
+                 sweep_interval: float = 60.0):
+        self.folder = folder
+        self.max_files = max_files
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def save(self, data: bytes, sha256: str, ext: str) -> str:
+        filename = f"{sha256[:32]}{ext}"
+        path = os.path.join(self.folder, filename)
+        if os.path.exists(path):
+            # Refresh the age so retention treats it as recently used.
+            os.utime(path)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix='.upload-', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        self.maybe_sweep()
+        return filename
+
+    def maybe_sweep(self):
+        with self._lock:
+            if time.monotonic() - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = time.monotonic()
+        self.sweep()
+
+    def sweep(self) -> int:
+        # Returns the number of files removed. Only stored images count; temporary
+        # writes and anything else in the folder (e.g. the result cache) stay.
+        if self.max_files is None and self.max_age is None:
+            return 0
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.startswith('.') or os.path.splitext(entry.name)[1].lower() not in STORED_EXTENSIONS:
+                    continue
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+        entries.sort(reverse=True)
+
+        now = time.time()
+        evict = []
+        for rank, (mtime, path) in enumerate(entries):
+            if (self.max_files is not None and rank >= self.max_files) or \
+                    (self.max_age is not None and now - mtime > self.max_age):
+                evict.append(path)
+        removed = 0
+        for path in evict:
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed